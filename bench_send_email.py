@@ -0,0 +1,489 @@
+"""Offline benchmarks for Send-email module.
+
+__author__ = 'Max Luckystar'
+__email__ = 'data.maxluckystar@gmail.com'
+__ website__ = ''
+__version__ = '1.0'
+
+Run ``python bench_send_email.py`` to measure the hot paths of a
+campaign without a database or a mail server: reading the email list,
+filling in the template, rendering messages and
+``process_name_email``.  The database is replaced by
+``SeededPostgreSqlDb`` serving reproducible synthetic ``lead`` and
+``email_template`` records and mail goes to the local fake SMTP server.
+For every stage rows or messages per second, p50/p99 latency per item
+and peak memory are reported; comparisons with ``string.Template`` and
+with the original one connection and one MIME rebuild per message are
+included.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import itertools
+import mimetypes
+import random
+import re
+import resource
+import statistics
+import time
+import tracemalloc
+from collections import namedtuple
+from string import Template
+
+from fake_smtp import FakeSmtpServer
+from send_email import (
+    AsyncSmtpPool, CompiledTemplate, Email, MessageSkeleton, PostgreSqlDb,
+    SmtpPool)
+
+SENDER = 'bench@example.com'
+TEMPLATE = Template(
+    '<p>Dear ${PERSON_NAME},</p><p>Happy New Year!</p>'
+    '<img src="cid:image_filename"><p>${SIGNATURE}</p>')
+FIRST_NAMES = ('anna', 'boris', 'chen', 'dmitry', 'eva', 'farid', 'gita',
+               'hans', 'irina', 'jose', 'kate', 'liam', 'maria', 'nikolai')
+DOMAINS = ('example.com', 'example.org', 'mail.example.net')
+
+# Items processed, seconds taken, seconds per item and peak bytes
+# allocated (None unless measured) of one benchmark stage
+Measurement = namedtuple('Measurement', 'name count seconds latencies peak')
+
+
+def seeded_leads(count, seed=0):
+    """Generate ``count`` reproducible (first name, email) lead rows.
+
+    About one lead in ten has no personal email and gets the work one,
+    as ``COALESCE(email, email_work)`` would return.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        first_name = rng.choice(FIRST_NAMES)
+        box = 'work.' if rng.random() < 0.1 else ''
+        yield first_name, '{}{}.{}@{}'.format(
+            box, first_name, i, rng.choice(DOMAINS))
+
+
+def seeded_templates(seed=0):
+    """Return reproducible ``email_template`` records by id."""
+    rng = random.Random(seed)
+    return {
+        template_id: (
+            TEMPLATE.template + '<p>{}</p>'.format('x' * rng.randint(
+                200, 2000)),
+            'Subject {}'.format(template_id), '***<br>')
+        for template_id in range(1, 11)}
+
+
+class _SeededCursor:
+    """Cursor serving seeded records for the queries of the module."""
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.itersize = 2000
+        self.closed = False
+        self._rows = iter(())
+
+    def execute(self, query, params=None):
+        if params is not None:
+            # psycopg2 fills in parameters with the % operator too, so
+            # a query with a bare % fails the same way
+            query = query % tuple(repr(param) for param in params)
+        self.connection.queries.append(query)
+        if query.startswith('SELECT version()'):
+            self._rows = iter([('PostgreSQL seeded stub',)])
+        elif query.startswith('SELECT min('):
+            self._rows = iter([(0, self.connection.lead_count - 1)])
+        elif 'FROM email_template' in query:
+            ids = {int(found) for found in re.findall(
+                r'(\d+)', query.partition(' WHERE ')[2])}
+            with_id = query.startswith('SELECT id, ')
+            self._rows = iter([
+                (template_id,) + record if with_id else record
+                for template_id, record
+                in self.connection.templates.items() if template_id in ids])
+        elif ' as segment ' in query:
+            # Seeded leads take turns in the segments
+            segments = query.partition(' as segment ')[0].count(' WHEN (')
+            self._rows = (
+                row + (i % segments,) for i, row in enumerate(seeded_leads(
+                    self.connection.lead_count, self.connection.seed)))
+        else:
+            self._rows = seeded_leads(
+                self.connection.lead_count, self.connection.seed)
+
+    def copy_expert(self, sql, file, size=8192):
+        # Keys of seeded leads are their positions
+        self.connection.queries.append(sql)
+        low = re.search(r'>= (\d+)', sql)
+        high = re.search(r'< (\d+)', sql)
+        for first_name, email in itertools.islice(
+                seeded_leads(self.connection.lead_count,
+                             self.connection.seed),
+                int(low.group(1)) if low else 0,
+                int(high.group(1)) if high else None):
+            # The server sends one message, and psycopg2 writes, per row
+            file.write('{}\t{}\n'.format(first_name, email).encode())
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def close(self):
+        self.closed = True
+
+
+class _SeededConnection:
+    """Connection handing out seeded cursors."""
+
+    def __init__(self, lead_count, seed):
+        self.lead_count = lead_count
+        self.seed = seed
+        self.templates = seeded_templates(seed)
+        self.queries = []
+        self.closed = 0
+
+    def cursor(self, name=None):
+        return _SeededCursor(self, name)
+
+    def get_dsn_parameters(self):
+        return {'dbname': 'seeded'}
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class SeededPostgreSqlDb(PostgreSqlDb):
+    """PostgreSqlDb reading synthetic records instead of a server."""
+
+    def __init__(self, lead_count, seed=0):
+        super().__init__('bench', 'bench', probe_version=False)
+        self.lead_count = lead_count
+        self.seed = seed
+
+    def connect_db(self):
+        self.connection = _SeededConnection(self.lead_count, self.seed)
+        self.cursor = self.connection.cursor()
+        return None
+
+    def _stream_db(self):
+        return SeededPostgreSqlDb(self.lead_count, self.seed)
+
+
+class _TimedSmtpPool(SmtpPool):
+    """SmtpPool recording how long every message took to send."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        started = time.perf_counter()
+        refused = super().sendmail(from_addr, to_addrs, msg)
+        self.latencies.append(time.perf_counter() - started)
+        return refused
+
+
+class _TimedAsyncSmtpPool(AsyncSmtpPool):
+    """AsyncSmtpPool recording how long every message took to send."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        started = time.perf_counter()
+        refused = await super().sendmail(from_addr, to_addrs, msg)
+        self.latencies.append(time.perf_counter() - started)
+        return refused
+
+
+def _measure(name, run, trace_memory):
+    """Run stage, return its Measurement.
+
+    ``run`` returns the number of items and their latencies.  With
+    ``trace_memory`` the stage runs again under ``tracemalloc`` to get
+    its peak allocation without slowing down the timed run.
+    """
+    started = time.perf_counter()
+    count, latencies = run()
+    seconds = time.perf_counter() - started
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return Measurement(name, count, seconds, latencies, peak)
+
+
+def bench_fetch(rows=2000, seed=0, trace_memory=True):
+    """Read the email list loaded at once and streamed.
+
+    :return: measurements of both modes
+    :rtype: list of Measurement
+    """
+    def fetch_all():
+        rows_read = SeededPostgreSqlDb(rows, seed).email_list_from_db(
+            'lead', condition='WHERE email is NOT NULL')
+        return len(rows_read), []
+
+    def stream():
+        latencies = []
+        count = 0
+        started = time.perf_counter()
+        for _ in SeededPostgreSqlDb(rows, seed).iter_email_list_from_db(
+                'lead', condition='WHERE email is NOT NULL'):
+            now = time.perf_counter()
+            latencies.append(now - started)
+            started = now
+            count += 1
+        return count, latencies
+
+    def copy(streams):
+        rows_read = list(SeededPostgreSqlDb(rows, seed).iter_email_list_copy(
+            'lead', condition='WHERE email is NOT NULL', streams=streams))
+        return len(rows_read), []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [_measure('email_list_from_db', fetch_all, trace_memory),
+                _measure('iter_email_list_from_db', stream, trace_memory),
+                _measure('iter_email_list_copy x1',
+                         functools.partial(copy, 1), trace_memory),
+                _measure('iter_email_list_copy x4',
+                         functools.partial(copy, 4), trace_memory)]
+
+
+def bench_render(rows=2000, seed=0, image_filename='NY.gif',
+                 trace_memory=True):
+    """Render messages rebuilding the MIME tree and from the skeleton.
+
+    :return: measurements of both modes
+    :rtype: list of Measurement
+    """
+    leads = list(seeded_leads(rows, seed))
+    email = Email(SENDER, subject='Bench')
+
+    def rebuild():
+        # The original loop body of process_name_email
+        latencies = []
+        for row in leads:
+            started = time.perf_counter()
+            email.email_create(row[1], email.from_, row[0], test=False)
+            email.add_section('Text', 'html', msg=TEMPLATE.substitute(
+                PERSON_NAME=row[0].title(), SIGNATURE='***'))
+            with open(image_filename, "rb") as img:
+                _, content_subtype = (
+                    mimetypes.guess_type(img.name)[0].split('/'))
+                email.add_section(
+                    'Image', image=img.read(), image_type=content_subtype,
+                    image_filename=image_filename)
+            email.message.as_string()
+            latencies.append(time.perf_counter() - started)
+        return len(leads), latencies
+
+    def skeleton(method):
+        latencies = []
+        render = getattr(MessageSkeleton(email, image_filename), method)
+        for row in leads:
+            started = time.perf_counter()
+            render(row[1], TEMPLATE.substitute(
+                PERSON_NAME=row[0].title(), SIGNATURE='***'))
+            latencies.append(time.perf_counter() - started)
+        return len(leads), latencies
+
+    # Rebuilding is slow, a tenth of the rows is enough to compare
+    full_leads, leads = leads, leads[:max(2, rows // 10)]
+    measurements = [_measure('render rebuild per message', rebuild,
+                             trace_memory)]
+    leads = full_leads
+    for method in ('render', 'render_bytes'):
+        measurements.append(_measure(
+            'skeleton {}'.format(method),
+            functools.partial(skeleton, method), trace_memory))
+    return measurements
+
+
+def bench_template(rows=2000, seed=0, trace_memory=True):
+    """Render template text with string.Template and compiled.
+
+    :return: measurements of both modes
+    :rtype: list of Measurement
+    """
+    leads = list(seeded_leads(rows, seed))
+    text = seeded_templates(seed)[1][0]
+    measurements = []
+    for name, template in (('string.Template.substitute', Template(text)),
+                           ('CompiledTemplate.substitute',
+                            CompiledTemplate(text))):
+        def render():
+            latencies = []
+            values = {'SIGNATURE': '***'}
+            for row in leads:
+                started = time.perf_counter()
+                template.substitute(values, PERSON_NAME=row[0].title())
+                latencies.append(time.perf_counter() - started)
+            return len(leads), latencies
+
+        measurements.append(_measure(name, render, trace_memory))
+    return measurements
+
+
+def bench_send(rows=2000, seed=0, image_filename='NY.gif', workers=1,
+               trace_memory=False, **server_options):
+    """Run process_name_email on streamed seeded leads.
+
+    :return: measurement of the run
+    :rtype: list of Measurement
+    """
+    def send():
+        with FakeSmtpServer(keep_messages=False,
+                            **server_options) as server:
+            email = Email(SENDER, 'localhost', server.port, 'Bench',
+                          use_ssl=False)
+            pool = _TimedSmtpPool('localhost', server.port, SENDER,
+                                  'secret', size=workers, use_ssl=False)
+            with pool:
+                email.process_name_email(
+                    'secret', SeededPostgreSqlDb(rows, seed)
+                    .iter_email_list_from_db('lead'), '***',
+                    image_filename, TEMPLATE, test_mode=False, pool=pool,
+                    workers=workers)
+        return pool.sent, pool.latencies
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [_measure('process_name_email x{}'.format(workers), send,
+                         trace_memory)]
+
+
+def bench_send_async(rows=2000, seed=0, image_filename='NY.gif',
+                     connections=10, **server_options):
+    """Run process_name_email_async on streamed seeded leads.
+
+    :return: measurement of the run
+    :rtype: list of Measurement
+    """
+    async def send_all(email):
+        async with _TimedAsyncSmtpPool(
+                'localhost', email.port, SENDER, 'secret',
+                size=connections, use_ssl=False) as pool:
+            await email.process_name_email_async(
+                'secret', SeededPostgreSqlDb(rows, seed)
+                .iter_email_list_from_db('lead'), '***', image_filename,
+                TEMPLATE, test_mode=False, pool=pool,
+                connections=connections)
+        return pool
+
+    def send():
+        with FakeSmtpServer(keep_messages=False,
+                            **server_options) as server:
+            pool = asyncio.run(send_all(Email(
+                SENDER, 'localhost', server.port, 'Bench', use_ssl=False)))
+        # Time from waiting for a session to the reply to the data,
+        # sends overlap so items/s is not the inverse of the latency
+        return pool.sent, pool.latencies
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [_measure('process_name_email_async x{}'.format(
+            connections), send, False)]
+
+
+def bench_pool(rows=200, seed=0, image_filename='NY.gif',
+               connect_delay=0.02, auth_delay=0.01):
+    """Send with a new SMTP session per message and with pooled ones.
+
+    The server delays the greeting and the login to emulate a TLS
+    handshake and AUTH round trip.  A pool recycling sessions after
+    every message behaves like the original loop.
+
+    :return: measurements of both modes
+    :rtype: list of Measurement
+    """
+    leads = list(seeded_leads(rows, seed))
+    measurements = []
+    for name, recycle_after in (('connect per message', 1),
+                                ('pooled sessions', 100)):
+        def send():
+            with FakeSmtpServer(connect_delay=connect_delay,
+                                auth_delay=auth_delay,
+                                keep_messages=False) as server:
+                email = Email(SENDER, 'localhost', server.port, 'Bench',
+                              use_ssl=False)
+                pool = _TimedSmtpPool(
+                    'localhost', server.port, SENDER, 'secret',
+                    max_messages=recycle_after, use_ssl=False)
+                with pool:
+                    email.process_name_email(
+                        'secret', leads, '***', image_filename, TEMPLATE,
+                        test_mode=False, pool=pool)
+            return pool.sent, pool.latencies
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            measurements.append(_measure(name, send, False))
+    return measurements
+
+
+def report(measurements):
+    """Print measurements as a table."""
+    print('{:<30} {:>7} {:>11} {:>9} {:>9} {:>10}'.format(
+        'stage', 'items', 'items/s', 'p50 ms', 'p99 ms', 'peak KiB'))
+    for measurement in measurements:
+        p50 = p99 = float('nan')
+        if len(measurement.latencies) > 1:
+            cuts = statistics.quantiles(measurement.latencies, n=100)
+            p50, p99 = cuts[49] * 1000, cuts[98] * 1000
+        peak = ('{:10.0f}'.format(measurement.peak / 1024)
+                if measurement.peak is not None else '{:>10}'.format('-'))
+        print('{:<30} {:7d} {:11.1f} {:9.3f} {:9.3f} {}'.format(
+            measurement.name, measurement.count,
+            measurement.count / measurement.seconds, p50, p99, peak))
+
+
+def main():
+    """Run benchmarks and print results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000,
+                        help='synthetic leads per stage (default 2000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--image', default='NY.gif')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='workers of the concurrent send (default 4)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc runs')
+    args = parser.parse_args()
+    trace_memory = not args.no_memory
+    started = time.perf_counter()
+    measurements = bench_fetch(args.rows, args.seed, trace_memory)
+    measurements += bench_template(args.rows, args.seed, trace_memory)
+    measurements += bench_render(
+        args.rows, args.seed, args.image, trace_memory)
+    measurements += bench_send(args.rows, args.seed, args.image)
+    measurements += bench_send(
+        args.rows, args.seed, args.image, workers=args.workers,
+        latency=0.001)
+    measurements += bench_send_async(
+        args.rows, args.seed, args.image, connections=args.workers,
+        latency=0.001)
+    measurements += bench_pool(
+        max(2, args.rows // 10), args.seed, args.image)
+    report(measurements)
+    print('Peak RSS {} KiB, done in {:.1f} s'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        time.perf_counter() - started))
+
+
+if __name__ == "__main__":
+    main()
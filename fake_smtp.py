@@ -0,0 +1,296 @@
+"""Local stand-in SMTP server for tests and offline benchmarks.
+
+__author__ = 'Max Luckystar'
+__email__ = 'data.maxluckystar@gmail.com'
+__ website__ = ''
+__version__ = '1.0'
+
+The server speaks just enough ESMTP (EHLO, AUTH PLAIN, MAIL, RCPT,
+DATA, RSET, NOOP, QUIT and PIPELINING) for ``smtplib`` to deliver
+messages to it.
+Delivered messages are kept as ``Envelope`` records, in the manner of
+``aiosmtpd``, so tests can inspect what was sent.  Delays can be added
+to the greeting and to the login to emulate the TLS handshake and AUTH
+round trips of a real server, and MAIL commands can be refused with
+temporary failures to emulate a server throttling the sender.
+"""
+
+import base64
+import socketserver
+import threading
+import time
+from collections import deque, namedtuple
+
+Envelope = namedtuple('Envelope', 'mail_from rcpt_tos content')
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """Serve one SMTP session."""
+
+    # Replies to pipelined commands are written one by one, Nagle's
+    # algorithm would hold each back until the previous one is acked
+    disable_nagle_algorithm = True
+
+    def reply(self, text):
+        """Send a (possibly multiline) reply to the client."""
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        """Read and answer commands until the client quits."""
+        fake = self.server.fake
+        fake.count('connections')
+        if fake.connect_delay:
+            time.sleep(fake.connect_delay)
+        self.reply('220 localhost fake ESMTP')
+        mail_from, rcpt_tos, delivered = None, [], 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command, _, arg = (
+                line.decode('ascii', 'replace').rstrip('\r\n')
+                .partition(' '))
+            command = command.upper()
+            if fake.latency:
+                time.sleep(fake.latency)
+            if command in ('EHLO', 'HELO'):
+                self.reply('250-localhost\r\n250-AUTH PLAIN\r\n'
+                           + ('250-PIPELINING\r\n' if fake.pipelining
+                              else '')
+                           + '250 SIZE 52428800')
+            elif command == 'AUTH':
+                self.auth(arg)
+            elif command == 'MAIL':
+                code = fake.throttle()
+                if code:
+                    self.reply('{} 4.7.0 Try again later'.format(code))
+                    if code == 421:
+                        break
+                    continue
+                mail_from, rcpt_tos = _address(arg), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                rcpt_tos.append(_address(arg))
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                content = self.read_data()
+                fake.deliver(Envelope(mail_from, rcpt_tos, content))
+                if fake.drop_reply():
+                    # Emulate a session lost after the message was taken
+                    break
+                mail_from, rcpt_tos = None, []
+                delivered += 1
+                self.reply('250 OK queued')
+                if (fake.disconnect_after
+                        and delivered >= fake.disconnect_after):
+                    # Emulate servers limiting messages per session
+                    break
+            elif command == 'RSET':
+                mail_from, rcpt_tos = None, []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+    def auth(self, arg):
+        """Check AUTH PLAIN credentials."""
+        fake = self.server.fake
+        mechanism, _, response = arg.partition(' ')
+        if mechanism.upper() != 'PLAIN':
+            self.reply('504 Unrecognized authentication type')
+            return
+        if not response:
+            self.reply('334 ')
+            response = self.rfile.readline().decode('ascii').strip()
+        try:
+            _, user, password = (
+                base64.b64decode(response).decode('utf-8').split('\0'))
+        except ValueError:
+            self.reply('501 Cannot decode response')
+            return
+        if fake.auth_delay:
+            time.sleep(fake.auth_delay)
+        if fake.password is not None and password != fake.password:
+            self.reply('535 Authentication credentials invalid')
+            return
+        fake.count('logins')
+        self.reply('235 Authentication successful')
+
+    def read_data(self):
+        """Read message content up to the terminating dot line."""
+        # Leading CRLF lets a dot on the first line be found as well
+        data = bytearray(b'\r\n')
+        while True:
+            chunk = self.rfile.peek(65536)
+            if not chunk:
+                break
+            start = max(0, len(data) - 4)
+            data += chunk
+            end = data.find(b'\r\n.\r\n', start)
+            if end >= 0:
+                # Leave commands pipelined after the data unread
+                self.rfile.read(len(chunk) - (len(data) - end - 5))
+                del data[end + 2:]
+                break
+            self.rfile.read(len(chunk))
+        return bytes(data[2:]).replace(b'\r\n..', b'\r\n.')
+
+
+def _address(arg):
+    """Extract the address from ``FROM:<addr>`` / ``TO:<addr>``."""
+    _, _, address = arg.partition(':')
+    return address.split(' ', 1)[0].strip().strip('<>')
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeSmtpServer:
+    """Threaded SMTP server listening on localhost.
+
+    Usable as a context manager::
+
+        with FakeSmtpServer(connect_delay=0.05) as server:
+            email = Email('me@example.com', 'localhost', server.port,
+                          use_ssl=False)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, password=None,
+                 connect_delay=0.0, auth_delay=0.0, latency=0.0,
+                 disconnect_after=None, keep_messages=True,
+                 reject_mail=(), max_rate=None, throttle_code=451,
+                 pipelining=True, drop_data_replies=0):
+        """Initialize fake SMTP server.
+
+        :param host: address to listen on, defaults to '127.0.0.1'
+        :type host: str, optional
+        :param port: port to listen on, 0 picks a free one, defaults
+            to 0
+        :type port: int, optional
+        :param password: accepted password, any password is accepted
+            if None, defaults to None
+        :type password: str, optional
+        :param connect_delay: seconds to wait before the greeting,
+            emulates TCP+TLS handshake, defaults to 0.0
+        :type connect_delay: float, optional
+        :param auth_delay: seconds to wait before accepting AUTH,
+            defaults to 0.0
+        :type auth_delay: float, optional
+        :param latency: seconds to wait before every reply, defaults to
+            0.0
+        :type latency: float, optional
+        :param disconnect_after: drop the session after that many
+            messages, defaults to None
+        :type disconnect_after: int, optional
+        :param keep_messages: keep delivered envelopes in
+            ``messages``, defaults to True
+        :type keep_messages: bool, optional
+        :param reject_mail: reply codes given to the next MAIL commands
+            one by one, 421 also closes the session, defaults to ()
+        :type reject_mail: list of int, optional
+        :param max_rate: MAIL commands accepted per second, more are
+            refused with ``throttle_code``, defaults to None
+        :type max_rate: int, optional
+        :param throttle_code: reply code refusing MAIL commands over
+            ``max_rate``, defaults to 451
+        :type throttle_code: int, optional
+        :param pipelining: advertise PIPELINING, defaults to True
+        :type pipelining: bool, optional
+        :param drop_data_replies: close the session instead of replying
+            to that many messages delivered, defaults to 0
+        :type drop_data_replies: int, optional
+        """
+        self.host = host
+        self.port = port
+        self.password = password
+        self.connect_delay = connect_delay
+        self.auth_delay = auth_delay
+        self.latency = latency
+        self.disconnect_after = disconnect_after
+        self.keep_messages = keep_messages
+        self.reject_mail = list(reject_mail)
+        self.max_rate = max_rate
+        self.throttle_code = throttle_code
+        self.pipelining = pipelining
+        self.drop_data_replies = drop_data_replies
+        self.messages = []
+        self.stats = {'connections': 0, 'logins': 0, 'messages': 0,
+                      'throttled': 0}
+        self._accepted = deque()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def count(self, name):
+        """Increase counter ``name`` by one."""
+        with self._lock:
+            self.stats[name] += 1
+
+    def throttle(self):
+        """Return reply code refusing next MAIL command, None to accept.
+
+        :return: SMTP reply code or None
+        :rtype: int
+        """
+        with self._lock:
+            code = None
+            if self.reject_mail:
+                code = self.reject_mail.pop(0)
+            elif self.max_rate:
+                now = time.monotonic()
+                while self._accepted and now - self._accepted[0] >= 1:
+                    self._accepted.popleft()
+                if len(self._accepted) >= self.max_rate:
+                    code = self.throttle_code
+                else:
+                    self._accepted.append(now)
+            if code:
+                self.stats['throttled'] += 1
+            return code
+
+    def drop_reply(self):
+        """Tell if the reply to the message delivered is to be dropped."""
+        with self._lock:
+            if self.drop_data_replies:
+                self.drop_data_replies -= 1
+                return True
+            return False
+
+    def deliver(self, envelope):
+        """Record delivered envelope."""
+        with self._lock:
+            self.stats['messages'] += 1
+            if self.keep_messages:
+                self.messages.append(envelope)
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._server = _ThreadingServer(
+            (self.host, self.port), _SmtpHandler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -8,25 +8,357 @@ __version__ = '1.0'
 
 """
 
-import smtplib
-import ssl
+import argparse
+import base64
+import collections
+import configparser
+import contextlib
+import copy
+import functools
+import getpass
+import hashlib
+import importlib.util
+import json
+import math
+import mmap
+import socket
 import mimetypes
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
 from string import Template
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
-import psycopg2
+from email.policy import compat32
+
+
+def _lazy_import(name):
+    """Return module loaded on first use of one of its attributes.
+
+    Keeps start-up fast for scheduled runs and worker processes that
+    need only a part of the module, a dry run does not load the SMTP
+    and asyncio modules for instance.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(
+            "No module named '{}'".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+asyncio = _lazy_import('asyncio')
+futures = _lazy_import('concurrent.futures')
+multiprocessing = _lazy_import('multiprocessing')
+psycopg2 = _lazy_import('psycopg2')
+smtplib = _lazy_import('smtplib')
+sqlite3 = _lazy_import('sqlite3')
+ssl = _lazy_import('ssl')
+
+# Everything a process needs to send a campaign on its own
+CampaignSettings = namedtuple(
+    'CampaignSettings',
+    'db_user db_password db_host db_port db_name sender_email '
+    'email_password template_id image_filename test_mode '
+    'ledger_filename incremental metrics outbox outbox_filename '
+    'copy_streams render_cache engine connections dry_run segments '
+    'campaign smtp_host smtp_port smtp_ssl per_minute per_day retries '
+    'backoff workers max_connections',
+    defaults=(False, False, None, 'send_outbox.sqlite', 0, None, 'sync',
+              10, False, (), '', 'smtp.gmail.com', 465, True, 20, 500, 3,
+              1.0, 1, None))
+
+# Leads matching SQL condition on the lead table get the template, a
+# lead in several segments is in the first one only
+Segment = namedtuple('Segment', 'name template_id condition')
+
+# What one segment is sent: ledger skips recipients already sent
+SegmentMessage = namedtuple(
+    'SegmentMessage', 'subject signature template ledger')
+
+# Outcome of sending to one recipient: status is 'sent', 'failed' or
+# 'skipped' (sent by an earlier run), error is None unless failed
+SendResult = namedtuple('SendResult', 'index row status error')
+
+
+class _StageTimer:
+    """Context manager adding its duration to a stage of Metrics."""
+
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+
+
+class Metrics:
+    """Timers and counters of campaign stages.
+
+    Disabled metrics hand out a shared do-nothing context manager, so
+    the instrumentation costs next to nothing unless ``enabled`` is
+    set.  Stages are timed with::
+
+        with METRICS.timer('render'):
+            ...
+
+    and counters increased with ``METRICS.count('messages_sent')``.
+    """
+
+    _NULL_TIMER = contextlib.nullcontext()
+
+    def __init__(self, enabled=False):
+        """Initialize empty metrics.
+
+        :param enabled: record metrics, defaults to False
+        :type enabled: bool, optional
+        """
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def timer(self, stage):
+        """Return context manager timing the stage.
+
+        :param stage: stage name
+        :type stage: str
+        :return: context manager
+        """
+        if not self.enabled:
+            return self._NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        """Add one call of the stage taking ``seconds``."""
+        with self._lock:
+            calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (
+                calls + 1, total + seconds, max(longest, seconds))
+
+    def count(self, name, value=1):
+        """Increase counter ``name`` by ``value``."""
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def snapshot(self):
+        """Return metrics as plain data, e.g. to send between processes.
+
+        :return: stages and counters
+        :rtype: dict
+        """
+        with self._lock:
+            return {'stages': dict(self.stages),
+                    'counters': dict(self.counters)}
+
+    def reset(self):
+        """Drop the stages and counters recorded so far."""
+        with self._lock:
+            self.stages = {}
+            self.counters = collections.Counter()
+
+    def merge(self, snapshot):
+        """Add metrics of a ``snapshot`` taken in another process."""
+        with self._lock:
+            for stage, (calls, total, longest) in (
+                    snapshot['stages'].items()):
+                own = self.stages.get(stage, (0, 0.0, 0.0))
+                self.stages[stage] = (
+                    own[0] + calls, own[1] + total, max(own[2], longest))
+            self.counters.update(snapshot['counters'])
+
+    def to_prometheus(self, prefix='inform_customers'):
+        """Return metrics in Prometheus text exposition format.
+
+        :return: metrics text
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE {}_stage_seconds summary'.format(prefix),
+            '# TYPE {}_stage_max_seconds gauge'.format(prefix)]
+        for stage, (calls, total, longest) in sorted(
+                snapshot['stages'].items()):
+            label = '{{stage="{}"}}'.format(stage)
+            lines.append('{}_stage_seconds_count{} {}'.format(
+                prefix, label, calls))
+            lines.append('{}_stage_seconds_sum{} {:.6f}'.format(
+                prefix, label, total))
+            lines.append('{}_stage_max_seconds{} {:.6f}'.format(
+                prefix, label, longest))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def to_json_lines(self):
+        """Return metrics as JSON lines, one per stage or counter.
+
+        :return: metrics text
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        lines = [
+            json.dumps({'stage': stage, 'calls': calls, 'seconds': total,
+                        'max_seconds': longest})
+            for stage, (calls, total, longest) in sorted(
+                snapshot['stages'].items())]
+        lines.extend(
+            json.dumps({'counter': name, 'value': value})
+            for name, value in sorted(snapshot['counters'].items()))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return table of stages and counters for the console.
+
+        :return: table text
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        stages = snapshot['stages']
+        overall = sum(total for _, total, _ in stages.values()) or 1.0
+        lines = ['{:<14} {:>9} {:>10} {:>9} {:>9} {:>6}'.format(
+            'stage', 'calls', 'total s', 'mean ms', 'max ms', 'share')]
+        for stage, (calls, total, longest) in sorted(
+                stages.items(), key=lambda item: -item[1][1]):
+            lines.append(
+                '{:<14} {:9d} {:10.3f} {:9.3f} {:9.3f} {:5.1f}%'.format(
+                    stage, calls, total, total / calls * 1000,
+                    longest * 1000, total / overall * 100))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('{:<14} {:9d}'.format(name, value))
+        return '\n'.join(lines)
+
+
+# Metrics of this process, enable with METRICS.enabled = True
+METRICS = Metrics()
+
+
+# Backslash escapes of the COPY text format
+_COPY_ESCAPE = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))')
+_COPY_CHARS = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+               'v': '\v'}
+
+
+def _copy_unescape(match):
+    """Return character a backslash sequence of COPY text stands for.
+
+    :param match: match of ``_COPY_ESCAPE``
+    :type match: re.Match
+    :return: octal or hexadecimal character, control character of
+        ``_COPY_CHARS`` or the escaped character itself
+    :rtype: str
+    """
+    octal, hexadecimal, char = match.groups()
+    if octal:
+        return chr(int(octal, 8))
+    if hexadecimal:
+        return chr(int(hexadecimal, 16))
+    return _COPY_CHARS.get(char, char)
+
+
+def _copy_rows(text):
+    """Parse whole lines of COPY text format into row tuples.
+
+    :param text: lines, each ended by a newline, text after the last
+        newline is ignored
+    :type text: str
+    :return: fields of every line, None for ``\\N``
+    :rtype: list of tuple
+    """
+    rows = []
+    for line in text.split('\n')[:-1]:
+        rows.append(tuple(
+            None if field == '\\N'
+            else _COPY_ESCAPE.sub(_copy_unescape, field) if '\\' in field
+            else field
+            for field in line.split('\t')))
+    return rows
+
+
+class _CopyCancelled(Exception):
+    """Rows of a COPY stream are no longer wanted."""
+
+
+class _CopyWriter:
+    """File ``copy_expert`` writes to, passes parsed rows on in chunks.
+
+    Only whole lines are parsed, the rest waits for the next write.
+    """
+
+    def __init__(self, chunks, stop, chunk_size=65536):
+        self.chunks = chunks
+        self.stop = stop
+        self.chunk_size = chunk_size
+        self.encoding = 'utf-8'
+        self._buffer = bytearray()
+
+    def write(self, data):
+        """Buffer data, parse whole lines once ``chunk_size`` is reached.
+
+        :param data: COPY text, a line may be split across writes
+        :type data: bytes
+        """
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Pass rows of the whole lines buffered on, keep the rest."""
+        end = self._buffer.rfind(b'\n') + 1
+        if end:
+            self.put(_copy_rows(self._buffer[:end].decode(self.encoding)))
+            del self._buffer[:end]
+
+    def put(self, rows):
+        """Queue rows, None ends the stream."""
+        while True:
+            if self.stop.is_set():
+                raise _CopyCancelled()
+            try:
+                self.chunks.put(rows, timeout=0.1)
+                return
+            except queue.Full:
+                pass
 
 
 class PostgreSqlDb:
     """Actions necessary to get data from PostgreSQL database.
 
+    Every query connects and disconnects on its own, unless the object
+    is used as a context manager: then one connection is opened lazily
+    by the first query and shared by all queries until the block ends::
+
+        with PostgreSqlDb(user, password) as postgresql_db:
+            template = postgresql_db.email_template(...)
+            rows = postgresql_db.iter_email_list_from_db(...)
+
     :return: Dataset containing selected records
     :rtype: dataset
     """
 
     def __init__(self, user, password, host='localhost', port='5432',
-                 db_='postgres'):
+                 db_='postgres', probe_version=True):
         """Initialize connection to PostgreSQL server database.
 
         :param user: PostgreSQL server User
@@ -41,19 +373,33 @@ class PostgreSqlDb:
         :type port: str, optional
         :param db_: Database name, defaults to 'postgres'
         :type db_: str, optional
+        :param probe_version: print connection properties and server
+            version on connect, defaults to True
+        :type probe_version: bool, optional
         """
         self.user = user
         self.password = password
         self.host = host
         self.port = port
         self.db_ = db_
+        self.probe_version = probe_version
         self.connection = None
         self.cursor = None
+        self.keep_open = False
+
+    def __enter__(self):
+        self.keep_open = True
+        return self
+
+    def __exit__(self, *exc_info):
+        self.keep_open = False
+        self.disconnect_db()
 
     def disconnect_db(self):
         """Close connection to PostgreSQL server."""
         if self.connection:
-            self.cursor.close()
+            if self.cursor:
+                self.cursor.close()
             self.connection.close()
             self.cursor = None
             self.connection = None
@@ -64,24 +410,45 @@ class PostgreSqlDb:
 
         Open connection to PostgreSQL server with parameters in the
         object and inform about the version of the database engine
+        if ``probe_version`` is set
         """
         try:
-            self.connection = psycopg2.connect(
-                user=self.user, password=self.password,
-                host=self.host, port=self.port, database=self.db_)
+            with METRICS.timer('db_connect'):
+                self.connection = psycopg2.connect(
+                    user=self.user, password=self.password,
+                    host=self.host, port=self.port, database=self.db_)
             self.cursor = self.connection.cursor()
-            # Print PostgreSQL connection properties
-            print(self.connection.get_dsn_parameters(), "\n")
-            # Print PostgreSQL version
-            self.cursor.execute("SELECT version();")
-            record = self.cursor.fetchone()
-            print("You are connected to - ", record, "\n")
+            if self.probe_version:
+                # Print PostgreSQL connection properties
+                print(self.connection.get_dsn_parameters(), "\n")
+                # Print PostgreSQL version
+                self.cursor.execute("SELECT version();")
+                record = self.cursor.fetchone()
+                print("You are connected to - ", record, "\n")
             return None
         except psycopg2.Error as error:
             print("Error while connecting to PostgreSQL", error)
             self.disconnect_db()
             return error
 
+    def open_db(self):
+        """Connect to PostgreSQL database unless already connected.
+
+        :return: None on success, connection error otherwise
+        :rtype: None or psycopg2.Error
+        """
+        if self.connection is not None and not self.connection.closed:
+            return None
+        return self.connect_db()
+
+    def close_db(self):
+        """Finish query, disconnect unless the connection is shared."""
+        if not self.keep_open:
+            self.disconnect_db()
+        elif self.connection is not None and not self.connection.closed:
+            # End the read transaction, keep the connection
+            self.connection.commit()
+
     def email_list_from_db(
                 self, table, firstname_col='first_name',
                 email_col='email', work_email_col='work_email',
@@ -106,25 +473,449 @@ class PostgreSqlDb:
         :rtype: dataset
         """
         try:
-            self.connect_db()
-            # Get first_name, email from database, if personal email
-            # exists get personal one otherwise get work_email
-            select = (
-                "SELECT {}, COALESCE({}, {}) as email FROM {} \
-                {} ORDER BY {}")
-            select = select.format(
-                firstname_col, email_col, work_email_col, table,
-                condition, orderby_col)
-            self.cursor.execute(select)
-            rows = self.cursor.fetchall()
+            if self.open_db() is not None:
+                return None
+            with METRICS.timer('db_query'):
+                self.cursor.execute(self._email_list_select(
+                    table, firstname_col, email_col, work_email_col,
+                    condition, orderby_col))
+            with METRICS.timer('db_fetch'):
+                rows = self.cursor.fetchall()
+            METRICS.count('rows_fetched', len(rows))
         except psycopg2.Error as error:
             print("Error while connecting to PostgreSQL", error)
             rows = None
+            self.disconnect_db()
         finally:
             # Close database connection.
-            self.disconnect_db()
+            self.close_db()
         return rows
 
+    def iter_email_list_from_db(
+                self, table, firstname_col='first_name',
+                email_col='email', work_email_col='work_email',
+                condition=None, orderby_col='id', itersize=2000):
+        """Stream first_name, email from PostgreSQL database.
+
+        Same query as ``email_list_from_db`` run through a named
+        (server-side) cursor, so rows arrive ``itersize`` at a time
+        instead of the whole table being loaded before the first one
+        is returned.  The connection stays open while the generator is
+        iterated and is closed when it is exhausted or closed, unless
+        it is shared by a ``with`` block.
+
+        :param table: Table name
+        :type table: str
+        :param firstname_col: Column name with first name, defaults to
+            'first_name'
+        :type firstname_col: str, optional
+        :param email_col: Column name with email, defaults to 'email'
+        :type email_col: str, optional
+        :param work_email_col: Column name with work email, defaults to
+            'work_email'
+        :type work_email_col: str, optional
+        :param condition: WHERE clause filter, defaults to None
+        :type condition: str, optional
+        :param orderby_col: Sort column name, defaults to 'id'
+        :type orderby_col: str, optional
+        :param itersize: rows fetched from the server at a time,
+            defaults to 2000
+        :type itersize: int, optional
+        :return: first name and email or work email for each row
+        :rtype: generator
+        """
+        return self._iter_select(self._email_list_select(
+            table, firstname_col, email_col, work_email_col, condition,
+            orderby_col), itersize)
+
+    def iter_segmented_email_list(
+                self, table, segments, firstname_col='first_name',
+                email_col='email', work_email_col='work_email',
+                condition=None, orderby_col='id', itersize=2000):
+        """Stream first_name, email and segment of rows in one pass.
+
+        Every row gets the number of the first of ``segments`` it
+        matches, see ``segment_case``, rows matching none are left
+        out.  One scan of the table serves all the segments of a
+        campaign.
+
+        :param table: Table name
+        :type table: str
+        :param segments: SQL condition of each segment, an empty one
+            matches every row
+        :type segments: list of str
+        :param condition: WHERE clause filter of all segments, defaults
+            to None
+        :type condition: str, optional
+        :return: first name, email or work email and segment number
+            for each row
+        :rtype: generator
+
+        The other parameters are those of ``iter_email_list_from_db``.
+        """
+        case = self.segment_case(segments)
+        select = (
+            "SELECT {}, COALESCE({}, {}) as email, {} as segment "
+            "FROM {} {} ORDER BY {}").format(
+                firstname_col, email_col, work_email_col, case, table,
+                self._and_condition(condition, case + " IS NOT NULL"),
+                orderby_col)
+        return self._iter_select(select, itersize)
+
+    @staticmethod
+    def segment_case(segments):
+        """Return SQL expression numbering the segment a row is in.
+
+        :param segments: SQL condition of each segment, an empty one
+            matches every row
+        :type segments: list of str
+        :return: CASE expression, NULL for rows in no segment
+        :rtype: str
+        """
+        return "CASE {} END".format(' '.join(
+            "WHEN ({}) THEN {}".format(segment or 'TRUE', number)
+            for number, segment in enumerate(segments)))
+
+    def _iter_select(self, select, itersize):
+        """Stream rows of SELECT through a named cursor."""
+        cursor = None
+        try:
+            if self.open_db() is not None:
+                return
+            cursor = self.connection.cursor(name='email_list')
+            cursor.itersize = itersize
+            with METRICS.timer('db_query'):
+                cursor.execute(select)
+            while True:
+                with METRICS.timer('db_fetch'):
+                    rows = cursor.fetchmany(itersize)
+                if not rows:
+                    break
+                METRICS.count('rows_fetched', len(rows))
+                yield from rows
+        except psycopg2.Error as error:
+            print("Error while connecting to PostgreSQL", error)
+            self.disconnect_db()
+        finally:
+            if cursor is not None and not cursor.closed:
+                cursor.close()
+            # Close database connection.
+            self.close_db()
+
+    def iter_email_list_copy(
+                self, table, firstname_col='first_name',
+                email_col='email', work_email_col='work_email',
+                condition=None, orderby_col='id', streams=1):
+        """Bulk export first_name, email with COPY TO STDOUT.
+
+        Same query as ``email_list_from_db`` run as ``COPY (...) TO
+        STDOUT``, which sends rows as one text stream instead of
+        result sets, and parsed as it arrives.  With more than one
+        stream the numeric ``orderby_col`` range is split into
+        ``streams`` ranges exported over their own connections in
+        parallel; rows are then ordered within a range only.
+
+        :param table: Table name
+        :type table: str
+        :param firstname_col: Column name with first name, defaults to
+            'first_name'
+        :type firstname_col: str, optional
+        :param email_col: Column name with email, defaults to 'email'
+        :type email_col: str, optional
+        :param work_email_col: Column name with work email, defaults to
+            'work_email'
+        :type work_email_col: str, optional
+        :param condition: WHERE clause filter, defaults to None
+        :type condition: str, optional
+        :param orderby_col: Sort column name, defaults to 'id'
+        :type orderby_col: str, optional
+        :param streams: parallel COPY streams, defaults to 1
+        :type streams: int, optional
+        :return: first name and email or work email for each row
+        :rtype: generator
+        """
+        conditions = [condition]
+        if streams > 1:
+            conditions = self.key_ranges(
+                table, orderby_col, condition, streams)
+        chunks = queue.Queue(maxsize=4 * len(conditions))
+        stop = threading.Event()
+        threads = []
+        for i, where in enumerate(conditions):
+            statement = "COPY ({}) TO STDOUT".format(self._email_list_select(
+                table, firstname_col, email_col, work_email_col, where,
+                orderby_col))
+            # The first range is read over the connection of the object
+            postgresql_db = self if i == 0 else self._stream_db()
+            threads.append(threading.Thread(
+                target=postgresql_db._copy_to,
+                args=(statement, _CopyWriter(chunks, stop)), daemon=True))
+        for thread in threads:
+            thread.start()
+        finished = 0
+        try:
+            while finished < len(threads):
+                with METRICS.timer('db_fetch'):
+                    rows = chunks.get()
+                if rows is None:
+                    finished += 1
+                    continue
+                METRICS.count('rows_fetched', len(rows))
+                yield from rows
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def key_ranges(self, table, key_col, condition, count):
+        """Split rows into WHERE clause filters on key ranges.
+
+        The range from the smallest to the largest ``key_col`` value
+        is cut into ``count`` equal parts; the first and the last
+        parts are open, so rows added meanwhile are not missed.  Keys
+        that are not integers are split by hash as in
+        ``shard_condition``.
+
+        :param table: Table name
+        :type table: str
+        :param key_col: integer key column
+        :type key_col: str
+        :param condition: WHERE clause filter, or None
+        :type condition: str
+        :param count: number of ranges
+        :type count: int
+        :return: WHERE clause filter for each range
+        :rtype: list of str
+        """
+        if count <= 1:
+            return [condition]
+        row = None
+        try:
+            if self.open_db() is None:
+                with METRICS.timer('db_query'):
+                    self.cursor.execute(
+                        "SELECT min({0}), max({0}) FROM {1} {2}".format(
+                            key_col, table, condition or ''))
+                    row = self.cursor.fetchone()
+        except psycopg2.Error as error:
+            print("Error while connecting to PostgreSQL", error)
+            self.disconnect_db()
+        finally:
+            self.close_db()
+        if not row or not all(isinstance(key, int) for key in row):
+            return [self.shard_condition(condition, key_col, i, count)
+                    for i in range(count)]
+        low, high = row
+        step = max(1, -(-(high - low + 1) // count))
+        bounds = [low + step * i for i in range(1, count)]
+        ranges = ["{} < {}".format(key_col, bounds[0])]
+        ranges += ["{0} >= {1} AND {0} < {2}".format(key_col, start, end)
+                   for start, end in zip(bounds, bounds[1:])]
+        ranges.append("{} >= {}".format(key_col, bounds[-1]))
+        return [self._and_condition(condition, key_range)
+                for key_range in ranges]
+
+    def _stream_db(self):
+        """Return object with a connection of its own to the database."""
+        return PostgreSqlDb(self.user, self.password, self.host, self.port,
+                            self.db_, probe_version=False)
+
+    def _copy_to(self, statement, writer):
+        """Run COPY TO STDOUT statement into the writer, in a thread."""
+        try:
+            if self.open_db() is not None:
+                return
+            writer.encoding = psycopg2.extensions.encodings.get(
+                getattr(self.connection, 'encoding', 'UTF8'), 'utf-8')
+            self.cursor.copy_expert(statement, writer, 65536)
+            writer.flush()
+        except _CopyCancelled:
+            # Connection is left in the middle of the COPY
+            self.disconnect_db()
+        except psycopg2.Error as error:
+            print("Error while connecting to PostgreSQL", error)
+            self.disconnect_db()
+        finally:
+            # Close database connection.
+            self.close_db()
+            try:
+                writer.put(None)
+            except _CopyCancelled:
+                pass
+
+    @staticmethod
+    def shard_condition(condition, key_col, shard_id, num_shards):
+        """Restrict WHERE clause to one shard of the rows.
+
+        Rows are split by a hash of ``key_col`` so every row belongs
+        to exactly one of ``num_shards`` shards numbered from 0.
+
+        :param condition: WHERE clause filter, or None
+        :type condition: str
+        :param key_col: column the rows are split by
+        :type key_col: str
+        :param shard_id: shard to keep
+        :type shard_id: int
+        :param num_shards: number of shards
+        :type num_shards: int
+        :return: WHERE clause filter
+        :rtype: str
+        """
+        # abs() of the lowest integer hashtext returns is out of range;
+        # mod() keeps a bare % out of queries run with parameters
+        shard = "mod(hashtext({}::text) & 2147483647, {}) = {}".format(
+            key_col, int(num_shards), int(shard_id))
+        return PostgreSqlDb._and_condition(condition, shard)
+
+    @staticmethod
+    def _and_condition(condition, extra):
+        """Add ``extra`` to WHERE clause filter ``condition``."""
+        if not condition:
+            return "WHERE " + extra
+        # Keep OR in the filter from swallowing the extra term
+        condition = re.sub(
+            r'^\s*WHERE\b', '', condition, flags=re.IGNORECASE)
+        return "WHERE ({}) AND {}".format(condition.strip(), extra)
+
+    def iter_email_list_since(
+            self, table, firstname_col='first_name', email_col='email',
+            work_email_col='work_email', condition=None, key_col='id',
+            since=None, page_size=1000):
+        """Stream first_name, email of rows past a high-water mark.
+
+        Rows come in pages ordered by ``key_col`` and every page starts
+        right after the last key of the previous one (keyset
+        pagination), so with an index on ``key_col`` only the new rows
+        are read, see ``incremental_index``.  ``key_col`` is an
+        increasing id or, for changed rows, a tuple such as
+        ``('updated_at', 'id')`` of a timestamp and a unique column.
+
+        :param table: Table name
+        :type table: str
+        :param firstname_col: Column name with first name, defaults to
+            'first_name'
+        :type firstname_col: str, optional
+        :param email_col: Column name with email, defaults to 'email'
+        :type email_col: str, optional
+        :param work_email_col: Column name with work email, defaults to
+            'work_email'
+        :type work_email_col: str, optional
+        :param condition: WHERE clause filter, defaults to None
+        :type condition: str, optional
+        :param key_col: key column or columns, defaults to 'id'
+        :type key_col: str or tuple, optional
+        :param since: key values of the high-water mark, all rows if
+            None, defaults to None
+        :type since: list, optional
+        :param page_size: rows read per query, defaults to 1000
+        :type page_size: int, optional
+        :return: first name, email and key values for each row
+        :rtype: generator
+        """
+        key_cols = [key_col] if isinstance(key_col, str) else list(key_col)
+        keys = ', '.join(key_cols)
+        select = (
+            "SELECT {}, COALESCE({}, {}) as email, {} FROM {} {} "
+            "ORDER BY {} LIMIT %s")
+        try:
+            if self.open_db() is not None:
+                return
+            while True:
+                where, params = condition, []
+                if since is not None:
+                    where = self._and_condition(
+                        condition, "({}) > ({})".format(
+                            keys, ', '.join(['%s'] * len(key_cols))))
+                    params = list(since)
+                with METRICS.timer('db_query'):
+                    self.cursor.execute(select.format(
+                        firstname_col, email_col, work_email_col, keys,
+                        table, where or '', keys), params + [page_size])
+                with METRICS.timer('db_fetch'):
+                    rows = self.cursor.fetchall()
+                METRICS.count('rows_fetched', len(rows))
+                yield from rows
+                if len(rows) < page_size:
+                    break
+                since = rows[-1][2:]
+        except psycopg2.Error as error:
+            print("Error while connecting to PostgreSQL", error)
+            self.disconnect_db()
+        finally:
+            # Close database connection.
+            self.close_db()
+
+    @staticmethod
+    def incremental_index(table, key_col='id', condition=None,
+                          concurrently=False):
+        """Return CREATE INDEX supporting ``iter_email_list_since``.
+
+        The index is partial on the filter, so it holds only the rows
+        the campaign can send to.
+
+        :param table: Table name
+        :type table: str
+        :param key_col: key column or columns, defaults to 'id'
+        :type key_col: str or tuple, optional
+        :param condition: WHERE clause filter, defaults to None
+        :type condition: str, optional
+        :param concurrently: build without blocking writes to the
+            table, outside of a transaction, defaults to False
+        :type concurrently: bool, optional
+        :return: SQL statement
+        :rtype: str
+        """
+        key_cols = [key_col] if isinstance(key_col, str) else list(key_col)
+        statement = "CREATE INDEX {}IF NOT EXISTS {}_{}_idx ON {} ({})".format(
+            'CONCURRENTLY ' if concurrently else '', table,
+            '_'.join(key_cols), table, ', '.join(key_cols))
+        if condition:
+            statement += re.sub(
+                r'^\s*WHERE\b', ' WHERE', condition, flags=re.IGNORECASE)
+        return statement
+
+    def create_incremental_index(self, table, key_col='id', condition=None):
+        """Create index supporting ``iter_email_list_since``.
+
+        The index is built concurrently, so leads can still be written
+        while it is built; that takes a connection in autocommit mode.
+
+        :return: None on success, error otherwise
+        :rtype: None or psycopg2.Error
+        """
+        try:
+            error = self.open_db()
+            if error is not None:
+                return error
+            # CREATE INDEX CONCURRENTLY cannot run in a transaction
+            self.connection.commit()
+            self.connection.autocommit = True
+            try:
+                with METRICS.timer('db_query'):
+                    self.cursor.execute(self.incremental_index(
+                        table, key_col, condition, concurrently=True))
+            finally:
+                self.connection.autocommit = False
+        except psycopg2.Error as error:
+            print("Error while connecting to PostgreSQL", error)
+            self.disconnect_db()
+            return error
+        finally:
+            self.close_db()
+        return None
+
+    @staticmethod
+    def _email_list_select(
+            table, firstname_col, email_col, work_email_col, condition,
+            orderby_col):
+        """Build SELECT of first name and email for the email list."""
+        # Get first_name, email from database, if personal email
+        # exists get personal one otherwise get work_email
+        select = "SELECT {}, COALESCE({}, {}) as email FROM {} {} ORDER BY {}"
+        return select.format(
+            firstname_col, email_col, work_email_col, table,
+            condition or '', orderby_col)
+
     def email_template(self, table, columns, where_statement):
         """Extract email template from PostgreSQL database.
 
@@ -138,57 +929,1849 @@ class PostgreSqlDb:
         :rtype: dataset
         """
         try:
-            self.connect_db()
+            if self.open_db() is not None:
+                return None
             # Get template from database with requested id
             select = "SELECT {} FROM {} WHERE {}"
             select = select.format(columns, table, where_statement)
-            self.cursor.execute(select)
-            rows = self.cursor.fetchall()
+            with METRICS.timer('db_query'):
+                self.cursor.execute(select)
+                rows = self.cursor.fetchall()
         except psycopg2.Error as error:
             print("Error while connecting to PostgreSQL", error)
             rows = None
+            self.disconnect_db()
         finally:
             # Close database connection.
-            self.disconnect_db()
+            self.close_db()
         return rows
 
+    def email_templates(self, table, columns, template_ids):
+        """Extract several email templates with one query.
 
-class Email:
-    """Actions necessary to create email."""
+        :param table: Table name with templates
+        :type table: str
+        :param columns: Column names of the template, without the id
+        :type columns: str
+        :param template_ids: ids of the templates
+        :type template_ids: iterable of int
+        :return: columns of each template found by its id, None on error
+        :rtype: dict
+        """
+        rows = self.email_template(
+            table, 'id, ' + columns, 'id IN ({})'.format(
+                ', '.join(str(int(template_id))
+                          for template_id in template_ids)))
+        if rows is None:
+            return None
+        return {row[0]: row[1:] for row in rows}
 
-    def __init__(
-            self, from_, smtp='smtp.gmail.com', port=465,
-            subject='Test', message=None):
-        """Initialize email class.
 
-        :param from_: sender email
-        :type from_: str, optional
-        :param smtp: SMTP host, defaults to 'smtp.gmail.com'
-        :type smtp: str, optional
-        :param port: SMTP port, defaults to 465
-        :type port: int, optional
-        :param subject: email subject, defaults to 'Test'
-        :type subject: str, optional
-        :param message: email body, , defaults to None
-        :type message: text template, optional
+# Mailbox providers ignoring the +tag part of an address
+PLUS_TAG_DOMAINS = frozenset(('gmail.com', 'googlemail.com'))
+
+
+def normalize_address(address):
+    """Return the canonical form of an email address for comparison.
+
+    Whitespace is stripped, the address is lower cased and the
+    ``+tag`` part Gmail ignores (and ``email_create`` adds in test mode)
+    is dropped.
+
+    :param address: email address
+    :type address: str
+    :return: normalized address, None if there is no address
+    :rtype: str
+    """
+    if not address:
+        return None
+    local, at, domain = address.strip().lower().rpartition('@')
+    if not at:
+        return domain or None
+    if domain in PLUS_TAG_DOMAINS:
+        local = local.partition('+')[0]
+    return '{}@{}'.format(local, domain)
+
+
+def _digest(key):
+    """Return 64 bit hash of the key as an integer."""
+    return int.from_bytes(hashlib.blake2b(
+        key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class BloomFilter:
+    """Set membership in a fixed size bit array, false positives aside.
+
+    Sized for ``capacity`` keys with a false positive rate of
+    ``error_rate``, e.g. 10 million keys at one in a million take
+    about 34 MiB.
+    """
+
+    def __init__(self, capacity, error_rate=1e-6):
+        """Initialize empty filter.
+
+        :param capacity: number of keys expected
+        :type capacity: int
+        :param error_rate: false positive rate at capacity, defaults to
+            1e-6
+        :type error_rate: float, optional
         """
-        self.smtp = smtp
-        self.port = port
-        self.from_ = from_
-        self.to_ = None
-        self.bcc = None
-        self.subject = subject
-        self.message = message
+        self.size = max(8, int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
 
-    def add_section(
-            self, section='Multipart', subtype='html', msg=None,
-            image=None, image_type=None, image_filename=None):
-        """Add part into multipart email message.
+    def add(self, key):
+        """Add key.
 
-        :param section: type of part email message to add, defaults to
-            'Multipart'
-        :type section: str, optional
-        :param subtype: body message type, defaults to 'html'
+        :param key: key to add
+        :type key: str
+        :return: True if the key was probably there before
+        :rtype: bool
+        """
+        return self.add_hash(_digest(key))
+
+    def add_hash(self, key_hash):
+        """Add key given by its 64 bit hash, see ``add``."""
+        # Double hashing from the two halves of the hash
+        hash1, hash2 = key_hash & 0xffffffff, (key_hash >> 32) | 1
+        present = True
+        for i in range(self.hashes):
+            position = (hash1 + i * hash2) % self.size
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                present = False
+                self.bits[byte] |= 1 << bit
+        return present
+
+
+class RecipientDeduper:
+    """Remember recipients seen in a stream with bounded memory.
+
+    Up to ``max_exact`` addresses are kept as 64 bit hashes, exact
+    but for a collision chance of about one in ten million at a million
+    addresses.
+    Past that the hashes move to a temporary SQLite file and memory
+    stops growing.  A Bloom filter sized for ``capacity`` addresses in
+    front of the file answers for new addresses, only its hits, with
+    probability ``error_rate`` for a new address, are looked up in the
+    file, so no new address is taken for a duplicate.
+    """
+
+    def __init__(self, max_exact=1000000, capacity=10000000,
+                 error_rate=1e-6):
+        """Initialize empty deduper.
+
+        :param max_exact: addresses kept exactly, defaults to 1000000
+        :type max_exact: int, optional
+        :param capacity: addresses expected in all, sizes the Bloom
+            filter, defaults to 10000000
+        :type capacity: int, optional
+        :param error_rate: false positive rate of the Bloom filter,
+            defaults to 1e-6
+        :type error_rate: float, optional
+        """
+        self.max_exact = max_exact
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.duplicates = 0
+        self._exact = set()
+        self._bloom = None
+        self._spilled = None
+
+    def seen(self, address):
+        """Tell if the address was seen before, remember it.
+
+        :param address: normalized email address
+        :type address: str
+        :return: True for a duplicate
+        :rtype: bool
+        """
+        key_hash = _digest(address)
+        if self._bloom is not None:
+            present = self._bloom.add_hash(key_hash) and self._spilled_hash(
+                key_hash)
+            if not present:
+                self._spill([key_hash])
+        elif key_hash in self._exact:
+            present = True
+        else:
+            present = False
+            self._exact.add(key_hash)
+            if len(self._exact) > self.max_exact:
+                self._bloom = BloomFilter(self.capacity, self.error_rate)
+                for exact_hash in self._exact:
+                    self._bloom.add_hash(exact_hash)
+                # Empty name is a temporary file removed on close
+                self._spilled = sqlite3.connect('', check_same_thread=False)
+                self._spilled.execute(
+                    "CREATE TABLE seen (hash INTEGER PRIMARY KEY)")
+                self._spill(self._exact)
+                self._exact = set()
+        if present:
+            self.duplicates += 1
+            METRICS.count('duplicates')
+        return present
+
+    def _spill(self, key_hashes):
+        """Write hashes to the temporary file."""
+        # SQLite integers are signed
+        self._spilled.executemany(
+            "INSERT OR IGNORE INTO seen VALUES (?)",
+            ((key_hash - 2 ** 63,) for key_hash in key_hashes))
+
+    def _spilled_hash(self, key_hash):
+        """Tell if hash is in the temporary file."""
+        METRICS.count('dedup_lookups')
+        return self._spilled.execute(
+            "SELECT 1 FROM seen WHERE hash = ?", (key_hash - 2 ** 63,)
+        ).fetchone() is not None
+
+    def close(self):
+        """Remove the temporary file."""
+        if self._spilled is not None:
+            self._spilled.close()
+            self._spilled = None
+
+
+def dedup_rows(name_email, deduper=None):
+    """Drop rows with a missing or already seen email address.
+
+    Addresses are compared in ``normalize_address`` form, rows are
+    passed on as they are.
+
+    :param name_email: name and email rows
+    :type name_email: iterable
+    :param deduper: seen addresses, a new one if None, defaults to None
+    :type deduper: RecipientDeduper, optional
+    :return: rows with unique addresses
+    :rtype: generator
+    """
+    if deduper is None:
+        deduper = RecipientDeduper()
+    for row in name_email:
+        address = normalize_address(row[1])
+        if address is not None and not deduper.seen(address):
+            yield row
+
+
+# SMTP reply codes worth retrying later: service not available,
+# mailbox busy, local error, insufficient storage, temporary auth failure
+TRANSIENT_SMTP_CODES = frozenset((421, 450, 451, 452, 454))
+
+
+class TokenBucket:
+    """Token bucket limiting the rate messages are sent at.
+
+    ``rate`` tokens are added every ``per`` seconds up to ``capacity``
+    and every message takes one, so a per-minute limit is
+    ``TokenBucket(20, per=60)`` and a daily quota is
+    ``TokenBucket(500, per=86400)``.  The rate adapts to the server:
+    it is halved when the server throttles and grows back gradually on
+    every message accepted.
+    """
+
+    def __init__(self, rate, per=1.0, capacity=None, min_rate=None,
+                 tokens=None):
+        """Initialize token bucket, full unless ``tokens`` is given.
+
+        :param rate: tokens added every ``per`` seconds
+        :type rate: float
+        :param per: refill period in seconds, defaults to 1.0
+        :type per: float, optional
+        :param capacity: maximum tokens, burst size, defaults to
+            ``rate``, at least 1
+        :type capacity: float, optional
+        :param min_rate: lowest rate the bucket slows down to, defaults
+            to a tenth of ``rate``
+        :type min_rate: float, optional
+        :param tokens: tokens at the start, defaults to ``capacity``
+        :type tokens: float, optional
+        """
+        self.max_rate = rate / per
+        self.min_rate = (min_rate or rate / 10) / per
+        self.rate = self.max_rate
+        # Less than one token could never be taken, as with a limit
+        # split between many shards
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity if tokens is None else tokens
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take(self):
+        """Take one token, return 0, or seconds until one is available."""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Take one token, wait until one is available."""
+        while True:
+            wait_time = self._take()
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+    async def acquire_async(self):
+        """Take one token, wait on the event loop until one is available."""
+        while True:
+            wait_time = self._take()
+            if not wait_time:
+                return
+            await asyncio.sleep(wait_time)
+
+    def seconds_for(self, count):
+        """Return seconds taking ``count`` tokens takes from full.
+
+        :param count: number of tokens
+        :type count: int
+        :return: seconds at the configured rate
+        :rtype: float
+        """
+        return max(0.0, (count - self.capacity) / self.max_rate)
+
+    def throttled(self):
+        """Slow down after the server asked to try again later."""
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def accepted(self):
+        """Speed up towards the configured rate after a success."""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self._refill()
+                self.rate = min(
+                    self.max_rate, self.rate + self.max_rate / 20)
+
+
+def _smtp_code(error):
+    """Return SMTP reply code of the error, None if there is none."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = {code for code, _ in error.recipients.values()}
+        # Retry only if every recipient was refused temporarily
+        return codes.pop() if len(codes) == 1 else None
+    return getattr(error, 'smtp_code', None)
+
+
+# Serializes messages with the CRLF line ends SMTP sends
+WIRE_POLICY = compat32.clone(linesep='\r\n')
+
+
+class WireMessage:
+    """Message bytes ready to be written after the DATA command.
+
+    Lines end with CRLF, lines starting with a dot are dot-stuffed and
+    the end of data line follows, so ``smtplib`` line end and dot
+    quoting, two regular expression passes over the whole message,
+    and the copies they make are skipped.
+    """
+
+    __slots__ = ('data',)
+
+    # Ends the data of every message
+    END = b'.\r\n'
+
+    def __init__(self, data):
+        """Wrap wire bytes without copying them.
+
+        :param data: quoted message followed by ``END``
+        :type data: bytes
+        """
+        self.data = data
+
+    def __bytes__(self):
+        return self.data[:-len(self.END)]
+
+    @classmethod
+    def from_message(cls, message):
+        """Serialize MIME message straight to wire bytes.
+
+        :param message: message to serialize
+        :type message: email.message.Message
+        :rtype: WireMessage
+        """
+        data = _quote_dots(message.as_bytes(policy=WIRE_POLICY))
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        return cls(data + cls.END)
+
+
+def _quote_dots(data):
+    """Double dots starting lines of CRLF separated bytes."""
+    data = data.replace(b'\r\n.', b'\r\n..')
+    return b'.' + data if data.startswith(b'.') else data
+
+
+def _data(server, msg):
+    """Send DATA command with wire message, like ``SMTP.data``."""
+    server.putcmd('data')
+    code, resp = server.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    server.send(msg.data)
+    try:
+        return server.getreply()
+    except smtplib.SMTPServerDisconnected as error:
+        # The message may have been accepted, see SmtpPool.sendmail
+        error.data_sent = True
+        raise
+
+
+def _sendmail(server, from_addr, to_addrs, msg):
+    """Send message, pipelining MAIL and RCPT commands if possible.
+
+    Works like ``smtplib.SMTP.sendmail``.  When the server advertises
+    PIPELINING, MAIL FROM and all RCPT TO commands are written at once
+    and the replies are read afterwards, saving a round trip per
+    recipient.  A ``WireMessage`` is written as it is, other messages
+    are converted to one first.
+    """
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    msg = _wire(msg)
+    server.ehlo_or_helo_if_needed()
+    if not server.has_extn('pipelining'):
+        return _sendmail_lockstep(server, from_addr, to_addrs, msg)
+    commands = ['MAIL FROM:{}'.format(smtplib.quoteaddr(from_addr))]
+    commands.extend('RCPT TO:{}'.format(smtplib.quoteaddr(address))
+                    for address in to_addrs)
+    server.send(''.join(command + '\r\n' for command in commands))
+    code, resp = server.getreply()
+    if code != 250:
+        # 421 ends the session before the RCPT commands are answered,
+        # the code is raised for the pool to slow down and reconnect
+        if code != 421:
+            try:
+                for _ in to_addrs:
+                    server.getreply()
+            except smtplib.SMTPServerDisconnected:
+                pass
+        _abort(server, code)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    # Every pipelined command gets its reply, read them all
+    rcpt_replies = [server.getreply() for _ in to_addrs]
+    refused = {
+        address: reply for address, reply in zip(to_addrs, rcpt_replies)
+        if reply[0] not in (250, 251)}
+    if len(refused) == len(to_addrs):
+        _abort(server, rcpt_replies[0][0])
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return _send_data(server, msg, refused)
+
+
+def _sendmail_lockstep(server, from_addr, to_addrs, msg):
+    """Send wire message without pipelining, reply after command."""
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        _abort(server, code)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for address in to_addrs:
+        reply = server.rcpt(address)
+        if reply[0] not in (250, 251):
+            refused[address] = reply
+    if len(refused) == len(to_addrs):
+        _abort(server, reply[0])
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return _send_data(server, msg, refused)
+
+
+def _send_data(server, msg, refused):
+    """Send wire message content of an open transaction."""
+    try:
+        code, resp = _data(server, msg)
+    except smtplib.SMTPDataError as error:
+        _abort(server, error.smtp_code)
+        raise
+    if code != 250:
+        _abort(server, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _abort(server, code):
+    """Reset failed transaction, close session the server ended."""
+    if code == 421:
+        server.close()
+    else:
+        try:
+            server.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+
+class _SmtpSession:
+    """Authenticated SMTP connection with a count of messages sent."""
+
+    def __init__(self, server):
+        self.server = server
+        self.sent = 0
+
+    def close(self):
+        """Say QUIT, ignore a server that is already gone."""
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+
+class SmtpPool:
+    """Pool of authenticated SMTP sessions reused across messages.
+
+    Opening a session costs a TCP+TLS handshake and an AUTH round trip,
+    so the pool keeps up to ``size`` sessions logged in and hands them
+    out for every message.  A session is recycled after
+    ``max_messages`` messages, and a session dropped by the server is
+    replaced by a fresh one transparently.
+
+    Sending waits for a token from every limiter of the pool.  Replies
+    the server gives for temporary failures (``TRANSIENT_SMTP_CODES``)
+    slow the limiters down and the message is retried after an
+    exponential backoff instead of failing at once.
+    """
+
+    def __init__(
+            self, smtp, port, user, password, size=1, max_messages=100,
+            use_ssl=True, timeout=60, limiters=(), retries=3,
+            backoff=1.0):
+        """Initialize SMTP session pool.
+
+        :param smtp: SMTP host
+        :type smtp: str
+        :param port: SMTP port
+        :type port: int
+        :param user: login user, usually sender email
+        :type user: str
+        :param password: login password
+        :type password: str
+        :param size: maximum number of open sessions, defaults to 1
+        :type size: int, optional
+        :param max_messages: messages sent through one session before
+            it is recycled, defaults to 100
+        :type max_messages: int, optional
+        :param use_ssl: connect with SMTP over SSL, plain SMTP
+            otherwise, defaults to True
+        :type use_ssl: bool, optional
+        :param timeout: socket timeout in seconds, defaults to 60
+        :type timeout: int, optional
+        :param limiters: rate limits of the sender on this server,
+            defaults to ()
+        :type limiters: list of TokenBucket, optional
+        :param retries: times a message is retried after a temporary
+            failure, defaults to 3
+        :type retries: int, optional
+        :param backoff: seconds to wait before the first retry, doubled
+            for every next one, defaults to 1.0
+        :type backoff: float, optional
+        """
+        self.smtp = smtp
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.max_messages = max_messages
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.limiters = list(limiters)
+        self.retries = retries
+        self.backoff = backoff
+        self.sent = 0
+        self.started = None
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self):
+        """Open and authenticate new SMTP session."""
+        with METRICS.timer('smtp_connect'):
+            if self.use_ssl:
+                # Create secure SSL context
+                context = ssl.create_default_context()
+                server = smtplib.SMTP_SSL(
+                    self.smtp, self.port, context=context,
+                    timeout=self.timeout)
+            else:
+                server = smtplib.SMTP(
+                    self.smtp, self.port, timeout=self.timeout)
+        try:
+            with METRICS.timer('smtp_login'):
+                server.login(self.user, self.password)
+        except (smtplib.SMTPException, OSError):
+            server.close()
+            raise
+        return _SmtpSession(server)
+
+    def acquire(self):
+        """Take idle session or open new one, wait if pool is full.
+
+        :return: SMTP session
+        :rtype: _SmtpSession
+        """
+        self._slots.acquire()
+        if self.started is None:
+            self.started = time.perf_counter()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, session, broken=False):
+        """Return session to the pool.
+
+        :param session: session taken with ``acquire``
+        :type session: _SmtpSession
+        :param broken: session can not be used any more, defaults to
+            False
+        :type broken: bool, optional
+        """
+        if broken:
+            session.server.close()
+        elif session.sent >= self.max_messages:
+            session.close()
+        else:
+            self._idle.put(session)
+        self._slots.release()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Send message through a pooled session.
+
+        A session closed by the server is replaced and the message is
+        sent again at once, unless the message was already sent and
+        only the reply to it was lost, which would deliver it twice.
+        Temporary failures are retried up to ``retries`` times with
+        exponential backoff.  Several recipients share one SMTP
+        transaction, pipelined if the server allows.
+
+        :param from_addr: envelope sender
+        :type from_addr: str
+        :param to_addrs: envelope recipient or list of recipients
+        :type to_addrs: str or list
+        :param msg: serialized message
+        :type msg: str or bytes
+        :return: refused recipients as returned by ``smtplib``
+        :rtype: dict
+        """
+        attempt = 0
+        while True:
+            for limiter in self.limiters:
+                limiter.acquire()
+            session = self.acquire()
+            try:
+                with METRICS.timer('smtp_send'):
+                    refused = _sendmail(
+                        session.server, from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected as error:
+                self.release(session, broken=True)
+                if getattr(error, 'data_sent', False):
+                    raise
+                failure, throttled = error, False
+            except (smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPResponseException) as error:
+                code = _smtp_code(error)
+                # 421 closes the session, other replies leave it usable
+                self.release(session, broken=code == 421)
+                if code not in TRANSIENT_SMTP_CODES:
+                    raise
+                failure, throttled = error, True
+            except BaseException:
+                self.release(session, broken=True)
+                raise
+            else:
+                session.sent += 1
+                self.release(session)
+                with self._lock:
+                    self.sent += 1
+                for limiter in self.limiters:
+                    limiter.accepted()
+                return refused
+            attempt += 1
+            METRICS.count('smtp_retries')
+            if attempt > self.retries:
+                raise failure
+            if throttled:
+                for limiter in self.limiters:
+                    limiter.throttled()
+            if throttled or attempt > 1:
+                # Exponential backoff with jitter
+                time.sleep(self.backoff * 2 ** (attempt - 1)
+                           * random.uniform(0.5, 1.0))
+
+    def rate(self):
+        """Return messages per second since the first message.
+
+        :return: messages per second
+        :rtype: float
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.started
+        return self.sent / elapsed if elapsed else 0.0
+
+    def close(self):
+        """Close all idle sessions."""
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            session.close()
+
+
+def _wire(msg):
+    """Return message as ``WireMessage``."""
+    if isinstance(msg, WireMessage):
+        return msg
+    if isinstance(msg, str):
+        msg = msg.encode('ascii')
+    data = _quote_dots(re.sub(rb'(?:\r\n|\n|\r(?!\n))', b'\r\n', msg))
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return WireMessage(data + WireMessage.END)
+
+
+class _AsyncSmtpSession:
+    """SMTP session on asyncio streams, as much as sending needs."""
+
+    def __init__(self, reader, writer, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.extensions = {}
+        self.sent = 0
+
+    async def reply(self):
+        """Read reply, multiline ones joined.
+
+        :return: reply code and text
+        :rtype: tuple
+        """
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(
+                    self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                raise smtplib.SMTPServerDisconnected('Reply timed out')
+            if not line.endswith(b'\n'):
+                raise smtplib.SMTPServerDisconnected(
+                    'Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                try:
+                    code = int(line[:3])
+                except ValueError:
+                    code = -1
+                return code, b'\n'.join(lines)
+
+    async def command(self, line):
+        """Send command, return its reply."""
+        self.writer.write(line.encode('ascii') + b'\r\n')
+        return await self.reply()
+
+    async def ehlo(self, local_hostname):
+        """Greet server, note the extensions it advertises.
+
+        :param local_hostname: name of this host sent with EHLO
+        :type local_hostname: str
+        """
+        code, resp = await self.command('EHLO {}'.format(local_hostname))
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, resp)
+        for line in resp.decode('ascii', 'replace').split('\n')[1:]:
+            name, _, params = line.partition(' ')
+            self.extensions[name.lower()] = params
+
+    async def login(self, user, password):
+        """Authenticate with AUTH PLAIN."""
+        if 'plain' not in self.extensions.get('auth', '').lower().split():
+            raise smtplib.SMTPNotSupportedError(
+                'AUTH PLAIN not supported by server.')
+        code, resp = await self.command('AUTH PLAIN ' + base64.b64encode(
+            '\0{}\0{}'.format(user, password).encode('utf-8')
+        ).decode('ascii'))
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """Send wire message, like ``_sendmail``.
+
+        :return: refused recipients
+        :rtype: dict
+        """
+        commands = ['MAIL FROM:{}'.format(smtplib.quoteaddr(from_addr))]
+        commands.extend('RCPT TO:{}'.format(smtplib.quoteaddr(address))
+                        for address in to_addrs)
+        if 'pipelining' in self.extensions:
+            self.writer.write(''.join(
+                command + '\r\n' for command in commands).encode('ascii'))
+            replies = [await self.reply()]
+            code, resp = replies[0]
+            if code == 250:
+                replies.extend([await self.reply() for _ in to_addrs])
+            elif code != 421:
+                # 421 ends the session before RCPT commands are answered
+                with contextlib.suppress(
+                        smtplib.SMTPServerDisconnected, OSError):
+                    for _ in to_addrs:
+                        await self.reply()
+        else:
+            replies = [await self.command(commands[0])]
+            code, resp = replies[0]
+            if code == 250:
+                replies.extend([await self.command(command)
+                                for command in commands[1:]])
+        if code != 250:
+            await self.abort(code)
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {
+            address: reply for address, reply in zip(to_addrs, replies[1:])
+            if reply[0] not in (250, 251)}
+        if len(refused) == len(to_addrs):
+            await self.abort(replies[1][0])
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = await self.command('DATA')
+        if code != 354:
+            await self.abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        self.writer.write(_wire(msg).data)
+        await self.writer.drain()
+        try:
+            code, resp = await self.reply()
+        except smtplib.SMTPServerDisconnected as error:
+            # The message may have been accepted, see SmtpPool.sendmail
+            error.data_sent = True
+            raise
+        if code != 250:
+            await self.abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def abort(self, code):
+        """Reset failed transaction, close session the server ended."""
+        if code == 421:
+            self.close()
+        else:
+            try:
+                await self.command('RSET')
+            except (smtplib.SMTPServerDisconnected, OSError):
+                pass
+
+    def close(self):
+        """Close connection."""
+        self.writer.close()
+
+    async def quit(self):
+        """Say goodbye to the server and close connection."""
+        try:
+            await self.command('QUIT')
+        except (smtplib.SMTPServerDisconnected, OSError):
+            pass
+        self.close()
+
+
+class AsyncSmtpPool:
+    """``SmtpPool`` for asyncio, sessions on non-blocking sockets.
+
+    Same sessions, limits, retries and backoff as ``SmtpPool``, for
+    coroutines: thousands of sends can be in flight from one thread
+    while waiting for the server.
+    """
+
+    def __init__(
+            self, smtp, port, user, password, size=10, max_messages=100,
+            use_ssl=True, timeout=60, limiters=(), retries=3,
+            backoff=1.0):
+        """Initialize SMTP session pool.
+
+        The parameters are those of ``SmtpPool``; ``size`` defaults
+        to 10.
+        """
+        self.smtp = smtp
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.max_messages = max_messages
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.limiters = list(limiters)
+        self.retries = retries
+        self.backoff = backoff
+        self.sent = 0
+        self.started = None
+        self._idle = []
+        self._slots = None
+        self._hostname_lookup = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _open(self):
+        """Open and authenticate new SMTP session."""
+        with METRICS.timer('smtp_connect'):
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        self.smtp, self.port,
+                        ssl=(ssl.create_default_context() if self.use_ssl
+                             else None)), self.timeout)
+            except asyncio.TimeoutError:
+                raise smtplib.SMTPServerDisconnected('Connect timed out')
+            session = _AsyncSmtpSession(reader, writer, self.timeout)
+        try:
+            code, resp = await session.reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, resp)
+            if self._hostname_lookup is None:
+                # getfqdn may wait for DNS, ask once and off the loop,
+                # sessions opened meanwhile wait for the same answer
+                self._hostname_lookup = asyncio.get_running_loop(
+                ).run_in_executor(None, socket.getfqdn)
+            await session.ehlo(await self._hostname_lookup)
+            with METRICS.timer('smtp_login'):
+                await session.login(self.user, self.password)
+        except (smtplib.SMTPException, OSError):
+            session.close()
+            raise
+        return session
+
+    async def acquire(self):
+        """Take idle session or open a new one, wait if all are busy.
+
+        :rtype: _AsyncSmtpSession
+        """
+        if self._slots is None:
+            # Created here to belong to the running event loop
+            self._slots = asyncio.Semaphore(self.size)
+        await self._slots.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+            if self.started is None:
+                self.started = time.perf_counter()
+            return await self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, session, broken=False):
+        """Give session back to the pool, close it if no longer usable."""
+        try:
+            if broken:
+                session.close()
+            elif session.sent >= self.max_messages:
+                await session.quit()
+            else:
+                self._idle.append(session)
+        finally:
+            self._slots.release()
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """Send message through a pooled session, see ``SmtpPool``.
+
+        :return: refused recipients
+        :rtype: dict
+        """
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        attempt = 0
+        while True:
+            for limiter in self.limiters:
+                await limiter.acquire_async()
+            session = await self.acquire()
+            try:
+                with METRICS.timer('smtp_send'):
+                    refused = await session.sendmail(
+                        from_addr, to_addrs, msg)
+            except (smtplib.SMTPServerDisconnected, OSError) as error:
+                await self.release(session, broken=True)
+                if getattr(error, 'data_sent', False):
+                    raise
+                failure, throttled = error, False
+            except (smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPResponseException) as error:
+                code = _smtp_code(error)
+                await self.release(session, broken=code == 421)
+                if code not in TRANSIENT_SMTP_CODES:
+                    raise
+                failure, throttled = error, True
+            except BaseException:
+                await self.release(session, broken=True)
+                raise
+            else:
+                session.sent += 1
+                await self.release(session)
+                self.sent += 1
+                for limiter in self.limiters:
+                    limiter.accepted()
+                return refused
+            attempt += 1
+            METRICS.count('smtp_retries')
+            if attempt > self.retries:
+                raise failure
+            if throttled:
+                for limiter in self.limiters:
+                    limiter.throttled()
+            if throttled or attempt > 1:
+                # Exponential backoff with jitter
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1)
+                                    * random.uniform(0.5, 1.0))
+
+    def rate(self):
+        """Return messages sent per second since the first session.
+
+        :rtype: float
+        """
+        if not self.started or not self.sent:
+            return 0.0
+        return self.sent / (time.perf_counter() - self.started)
+
+    async def close(self):
+        """Quit idle sessions."""
+        idle, self._idle = self._idle, []
+        for session in idle:
+            await session.quit()
+
+
+class SendLedger:
+    """Durable record of the recipients a campaign was sent to.
+
+    The ledger is a SQLite file with one row per campaign and
+    recipient, and the high-water marks of incremental campaigns.
+    Rerunning a campaign with the same ledger skips the recipients
+    already sent, so a crashed run resumes where it stopped instead of
+    sending everything again.  Records are written in
+    batches of ``batch_size``, which is the most a crash can lose.
+    """
+
+    def __init__(self, filename, campaign, batch_size=500):
+        """Open ledger file and load recipients already sent.
+
+        :param filename: SQLite file name, created if missing
+        :type filename: str
+        :param campaign: campaign name the records belong to
+        :type campaign: str
+        :param batch_size: records written per transaction, defaults
+            to 500
+        :type batch_size: int, optional
+        """
+        self.filename = filename
+        self.campaign = campaign
+        self.batch_size = batch_size
+        # Shards running in other processes may hold the write lock
+        self.connection = sqlite3.connect(
+            filename, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS send_ledger ("
+            "campaign TEXT NOT NULL, recipient TEXT NOT NULL, "
+            "status TEXT NOT NULL, error TEXT, updated REAL NOT NULL, "
+            "PRIMARY KEY (campaign, recipient))")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS send_watermark ("
+            "campaign TEXT NOT NULL, name TEXT NOT NULL, "
+            "keys TEXT NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (campaign, name))")
+        self.connection.commit()
+        self._sent = {
+            row[0] for row in self.connection.execute(
+                "SELECT recipient FROM send_ledger "
+                "WHERE campaign = ? AND status = 'sent'", (campaign,))}
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def already_sent(self, recipient):
+        """Tell if the campaign was already sent to the recipient.
+
+        :param recipient: receiver email
+        :type recipient: str
+        :return: True if sent by this or an earlier run
+        :rtype: bool
+        """
+        return recipient in self._sent
+
+    def sent_count(self):
+        """Return number of recipients the campaign was sent to.
+
+        :rtype: int
+        """
+        return len(self._sent)
+
+    def record(self, recipient, error=None):
+        """Record outcome of sending to the recipient.
+
+        :param recipient: receiver email
+        :type recipient: str
+        :param error: sending error, None if sent, defaults to None
+        :type error: Exception, optional
+        """
+        status = 'sent' if error is None else 'failed'
+        with self._lock:
+            if error is None:
+                self._sent.add(recipient)
+            self._pending.append((
+                self.campaign, recipient, status,
+                None if error is None else str(error), time.time()))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        """Write pending records to the ledger file."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO send_ledger "
+                "VALUES (?, ?, ?, ?, ?)", self._pending)
+            self.connection.commit()
+            self._pending = []
+
+    def watermark(self, name='leads'):
+        """Return high-water mark of the campaign.
+
+        :param name: name of the mark, defaults to 'leads'
+        :type name: str, optional
+        :return: key values of the last row read, None if not set
+        :rtype: list
+        """
+        row = self.connection.execute(
+            "SELECT keys FROM send_watermark "
+            "WHERE campaign = ? AND name = ?", (self.campaign, name)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_watermark(self, keys, name='leads'):
+        """Store high-water mark of the campaign with pending records.
+
+        :param keys: key values of the last row read
+        :type keys: list
+        :param name: name of the mark, defaults to 'leads'
+        :type name: str, optional
+        """
+        with self._lock:
+            self._flush()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO send_watermark VALUES (?, ?, ?, ?)",
+                (self.campaign, name, json.dumps([str(key) for key in keys]),
+                 time.time()))
+            self.connection.commit()
+
+    def close(self):
+        """Write pending records and close the ledger file."""
+        self.flush()
+        self.connection.close()
+
+
+class Outbox:
+    """Durable queue of rendered messages waiting for delivery.
+
+    Rendering a campaign into the outbox and delivering it are separate
+    steps, so a campaign can be rendered ahead of the send window and a
+    slow SMTP server does not hold rendering up.  The outbox is a
+    SQLite file with one row per serialized message.  Messages are
+    written in batches of ``batch_size`` with one fsync per batch.
+    Delivery workers claim messages in batches and renew the claim
+    while they send; a claim not renewed or acknowledged within
+    ``lease`` seconds, by a worker that crashed, is handed out again.
+    Outcomes are written as soon as each message is sent.  Recipients
+    a message failed for can be rendered into the outbox again.
+    """
+
+    def __init__(self, filename, campaign, batch_size=500, lease=600):
+        """Open outbox file and load recipients already queued.
+
+        :param filename: SQLite file name, created if missing
+        :type filename: str
+        :param campaign: campaign name the messages belong to
+        :type campaign: str
+        :param batch_size: messages written per transaction, defaults
+            to 500
+        :type batch_size: int, optional
+        :param lease: seconds a claimed message is kept from other
+            workers, defaults to 600
+        :type lease: float, optional
+        """
+        self.filename = filename
+        self.campaign = campaign
+        self.batch_size = batch_size
+        self.lease = lease
+        # Producers and workers in other processes share the file
+        self.connection = sqlite3.connect(
+            filename, timeout=30, check_same_thread=False,
+            isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # Every committed batch is on disk before it is acknowledged
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY, campaign TEXT NOT NULL, "
+            "from_addr TEXT NOT NULL, recipients TEXT NOT NULL, "
+            "message TEXT NOT NULL, status TEXT NOT NULL, error TEXT, "
+            "claimed REAL, updated REAL NOT NULL, "
+            "UNIQUE (campaign, recipients))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_status "
+            "ON outbox (campaign, status, id)")
+        self._queued = set()
+        for recipients, status, error in self.connection.execute(
+                "SELECT recipients, status, error FROM outbox "
+                "WHERE campaign = ? AND status != 'failed'", (campaign,)):
+            recipients = json.loads(recipients)
+            if status == 'partial':
+                # Recipients refused are left to be queued again
+                refused = json.loads(error)
+                recipients = [to_ for to_ in recipients
+                              if to_ not in refused]
+            self._queued.update(recipients)
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def already_queued(self, recipient):
+        """Tell if a message to the recipient is in the outbox.
+
+        :param recipient: receiver email
+        :type recipient: str
+        :return: True if queued by this or an earlier run
+        :rtype: bool
+        """
+        return recipient in self._queued
+
+    def put(self, from_addr, to_addrs, message):
+        """Queue serialized message for delivery.
+
+        :param from_addr: sender email
+        :type from_addr: str
+        :param to_addrs: receiver emails
+        :type to_addrs: list of str
+        :param message: message ready for ``sendmail``
+        :type message: str or WireMessage
+        """
+        with self._lock:
+            self._queued.update(to_addrs)
+            if isinstance(message, WireMessage):
+                message = message.data
+            self._pending.append((
+                self.campaign, from_addr, json.dumps(to_addrs), message,
+                'queued', None, None, time.time()))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def claim(self, limit=100):
+        """Take queued messages for delivery by this worker.
+
+        :param limit: most messages to take, defaults to 100
+        :type limit: int, optional
+        :return: (id, from_addr, to_addrs, message) for every message
+        :rtype: list of tuple
+        """
+        now = time.time()
+        with self._lock:
+            self._flush()
+            # Immediate transaction keeps workers in other processes
+            # from claiming the same messages
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT id, from_addr, recipients, message FROM outbox "
+                    "WHERE campaign = ? AND (status = 'queued' OR "
+                    "(status = 'claimed' AND claimed < ?)) "
+                    "ORDER BY id LIMIT ?",
+                    (self.campaign, now - self.lease, limit)).fetchall()
+                self.connection.executemany(
+                    "UPDATE outbox SET status = 'claimed', claimed = ? "
+                    "WHERE id = ?", [(now, row[0]) for row in rows])
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        # Wire messages come back from the file as plain bytes
+        return [(id_, from_addr, json.loads(recipients),
+                 WireMessage(message) if isinstance(message, bytes)
+                 else message)
+                for id_, from_addr, recipients, message in rows]
+
+    def renew(self, message_ids):
+        """Extend the lease of messages claimed and not yet done.
+
+        :param message_ids: ids returned by ``claim``
+        :type message_ids: list of int
+        """
+        with self._lock:
+            self.connection.executemany(
+                "UPDATE outbox SET claimed = ? "
+                "WHERE id = ? AND status = 'claimed'",
+                [(time.time(), message_id) for message_id in message_ids])
+
+    def done(self, message_id, error=None, refused=None):
+        """Record outcome of delivering claimed message.
+
+        The outcome is written at once, so the message is not handed
+        out again once it was sent.
+
+        :param message_id: id returned by ``claim``
+        :type message_id: int
+        :param error: delivery error, None if sent, defaults to None
+        :type error: Exception, optional
+        :param refused: errors of the recipients refused when the
+            others were sent, defaults to None
+        :type refused: dict, optional
+        """
+        if error is not None:
+            status, error = 'failed', str(error)
+        elif refused:
+            status, error = 'partial', json.dumps(
+                {to_: str(refused[to_]) for to_ in refused})
+        else:
+            status = 'sent'
+        with self._lock, METRICS.timer('outbox_write'):
+            self.connection.execute(
+                "UPDATE outbox SET status = ?, error = ?, updated = ? "
+                "WHERE id = ?", (status, error, time.time(), message_id))
+
+    def counts(self):
+        """Return number of messages of the campaign by status.
+
+        :rtype: collections.Counter
+        """
+        self.flush()
+        return collections.Counter(dict(self.connection.execute(
+            "SELECT status, count(*) FROM outbox WHERE campaign = ? "
+            "GROUP BY status", (self.campaign,))))
+
+    def flush(self):
+        """Write pending messages to the outbox file."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        with METRICS.timer('outbox_write'):
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # A message that failed is replaced by the new one
+                self.connection.executemany(
+                    "INSERT INTO outbox (campaign, from_addr, "
+                    "recipients, message, status, error, claimed, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (campaign, recipients) DO UPDATE SET "
+                    "from_addr = excluded.from_addr, "
+                    "message = excluded.message, status = excluded.status, "
+                    "error = NULL, claimed = NULL, "
+                    "updated = excluded.updated "
+                    "WHERE outbox.status = 'failed'", self._pending)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        self._pending = []
+
+    def close(self):
+        """Write pending messages and close the outbox file."""
+        self.flush()
+        self.connection.close()
+
+
+class CompiledTemplate:
+    """``string.Template`` parsed once into literal chunks and slots.
+
+    ``string.Template.substitute`` scans the whole text with a regular
+    expression on every call.  Here the text is scanned once and
+    rendering only joins the literal chunks with the values of the
+    slots.  ``substitute`` and ``safe_substitute`` work like the ones
+    of ``string.Template``, so both can be used as email template.
+    """
+
+    def __init__(self, template):
+        """Parse template text.
+
+        :param template: text with ``$NAME`` / ``${NAME}`` placeholders
+        :type template: str
+        """
+        self.template = template
+        self._chunks = []
+        self._slots = []
+        self._invalid = None
+        literal = []
+        position = 0
+        for match in Template.pattern.finditer(template):
+            literal.append(template[position:match.start()])
+            position = match.end()
+            name = match.group('named') or match.group('braced')
+            if name is not None:
+                self._chunks.append(''.join(literal))
+                literal = []
+                self._slots.append((len(self._chunks), name))
+                self._chunks.append(match.group())
+            elif match.group('escaped') is not None:
+                literal.append(Template.delimiter)
+            else:
+                # Lone delimiter, substitute fails like string.Template
+                literal.append(match.group())
+                if self._invalid is None:
+                    lines = template[:match.start()].splitlines(True)
+                    self._invalid = (
+                        'Invalid placeholder in string: line {}, col {}'
+                        .format(len(lines) or 1,
+                                len(lines[-1]) + 1 if lines else 1))
+        literal.append(template[position:])
+        self._chunks.append(''.join(literal))
+
+    @property
+    def identifiers(self):
+        """Placeholder names in order of first appearance."""
+        return list(dict.fromkeys(name for _, name in self._slots))
+
+    def substitute(self, mapping=None, **kws):
+        """Render template, KeyError if a placeholder has no value.
+
+        :return: rendered text
+        :rtype: str
+        """
+        if self._invalid is not None:
+            raise ValueError(self._invalid)
+        values = _values(mapping, kws)
+        chunks = self._chunks.copy()
+        for position, name in self._slots:
+            chunks[position] = str(values[name])
+        return ''.join(chunks)
+
+    def safe_substitute(self, mapping=None, **kws):
+        """Render template, keep placeholders that have no value.
+
+        :return: rendered text
+        :rtype: str
+        """
+        values = _values(mapping, kws)
+        chunks = self._chunks.copy()
+        for position, name in self._slots:
+            if name in values:
+                chunks[position] = str(values[name])
+        return ''.join(chunks)
+
+
+def _values(mapping, kws):
+    """Merge template values the way ``string.Template`` does."""
+    if mapping is None:
+        return kws
+    if kws:
+        return collections.ChainMap(kws, mapping)
+    return mapping
+
+
+class TemplateCache:
+    """LRU cache of compiled templates.
+
+    Templates are keyed by template id and a hash of their content, so
+    a template edited in the database is compiled again while an
+    unchanged one is compiled only once per process.
+    """
+
+    def __init__(self, maxsize=32):
+        """Initialize empty cache.
+
+        :param maxsize: compiled templates kept, defaults to 32
+        :type maxsize: int, optional
+        """
+        self.maxsize = maxsize
+        self._templates = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, template_id, template):
+        """Return compiled template, compile it if not cached.
+
+        :param template_id: id of the template in the database
+        :type template_id: int
+        :param template: template text
+        :type template: str
+        :return: compiled template
+        :rtype: CompiledTemplate
+        """
+        key = (template_id,
+               hashlib.sha256(template.encode('utf-8')).hexdigest())
+        with self._lock:
+            compiled = self._templates.get(key)
+            if compiled is not None:
+                self._templates.move_to_end(key)
+                return compiled
+        compiled = CompiledTemplate(template)
+        with self._lock:
+            self._templates[key] = compiled
+            if len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return compiled
+
+
+TEMPLATE_CACHE = TemplateCache()
+
+
+def compile_template(template_id, template):
+    """Return compiled template from the process wide cache.
+
+    :param template_id: id of the template in the database
+    :type template_id: int
+    :param template: template text
+    :type template: str
+    :return: compiled template
+    :rtype: CompiledTemplate
+    """
+    return TEMPLATE_CACHE.get(template_id, template)
+
+
+# First names repeat a lot, title case each of them once
+_title = functools.lru_cache(maxsize=4096)(str.title)
+
+
+@functools.lru_cache(maxsize=64)
+def _content_hash(text):
+    """Return hex SHA-256 of text, computed once per text."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """On-disk content-addressed cache of rendered html parts.
+
+    Recurring campaigns render the same template with the same values
+    for the same recipients again and again.  Entries are keyed by a
+    hash of the template text and all substitution values, so an edited
+    template or a changed value is a miss, and hold the html part as
+    sent.  Hits are read through ``mmap`` and spliced into the message
+    without an intermediate copy.  The least recently used entries are
+    deleted once the files take more than ``max_bytes``; file times
+    keep the order between runs.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 2 ** 20):
+        """Open cache directory and index the entries in it.
+
+        :param directory: cache directory, created if missing
+        :type directory: str
+        :param max_bytes: most bytes of entries kept, defaults to
+            256 MiB
+        :type max_bytes: int, optional
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for subdirectory in os.scandir(directory):
+            if subdirectory.is_dir():
+                for entry in os.scandir(subdirectory.path):
+                    if not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, entry.name,
+                                      stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.size += size
+
+    @staticmethod
+    def key(template, values):
+        """Return cache key of template rendered with values.
+
+        :param template: template text
+        :type template: str
+        :param values: all values the template is rendered with
+        :type values: dict
+        :rtype: str
+        """
+        fields = [_content_hash(template)]
+        for name in sorted(values):
+            fields += (name, str(values[name]))
+        return hashlib.sha256(
+            '\0'.join(fields).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    @contextlib.contextmanager
+    def read(self, key):
+        """Map cached entry, for use in a ``with`` statement.
+
+        :param key: key from ``key``
+        :type key: str
+        :return: entry content, None if not cached
+        :rtype: mmap.mmap or bytes
+        """
+        try:
+            entry = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                # Maybe evicted by a process sharing the directory
+                self.size -= self._entries.pop(key, 0)
+            METRICS.count('render_cache_misses')
+            yield None
+            return
+        with entry:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+            os.utime(entry.fileno())
+            METRICS.count('render_cache_hits')
+            try:
+                data = mmap.mmap(entry.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can not be mapped
+                yield b''
+                return
+            with data:
+                yield data
+
+    def put(self, key, data):
+        """Store entry, evict least recently used ones over the limit.
+
+        :param key: key from ``key``
+        :type key: str
+        :param data: entry content
+        :type data: bytes
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers see the whole entry or none of it
+        temporary = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.get_ident())
+        with open(temporary, 'wb') as entry:
+            entry.write(data)
+        os.replace(temporary, path)
+        evicted = []
+        with self._lock:
+            self.size += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self.size -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except FileNotFoundError:
+                pass
+
+
+class MessageSkeleton:
+    """Pre-serialized campaign message with per-recipient slots.
+
+    Headers and the inline image are identical for every recipient, so
+    the image is read and base64 encoded once and the serialized
+    message is cut into static chunks around the ``To`` header and the
+    html part.  Rendering a message only splices the recipient and the
+    personalized html into the chunks.
+    """
+
+    _TO_MARK = 'to.skeleton.mark@localhost'
+    _HTML_MARK = 'HTML_SKELETON_MARK'
+    _HTML_ASCII = (
+        'Content-Type: text/html; charset="us-ascii"\n'
+        'MIME-Version: 1.0\nContent-Transfer-Encoding: 7bit\n\n')
+    _HTML_UTF8 = (
+        'Content-Type: text/html; charset="utf-8"\n'
+        'MIME-Version: 1.0\nContent-Transfer-Encoding: base64\n\n')
+
+    def __init__(self, email, image_filename):
+        """Read image and serialize static parts of the message.
+
+        :param email: email with sender and subject of the campaign
+        :type email: Email
+        :param image_filename: image file name attached inline
+        :type image_filename: str
+        """
+        self.email = email
+        self.image_filename = image_filename
+        with open(image_filename, "rb") as img:
+            self.image = img.read()
+        _, self.image_type = (
+            mimetypes.guess_type(image_filename)[0].split('/'))
+        message = self._build(self._TO_MARK, self._HTML_MARK)
+        text = message.as_string()
+        self.boundary = message.get_boundary()
+        html_part = MIMEText(self._HTML_MARK, 'html').as_string()
+        self._head, rest = text.split(self._TO_MARK)
+        self._middle, self._tail = rest.split(html_part)
+        # The same chunks as wire bytes, the base64 image is encoded
+        # and dot-stuffed here once
+        data = WireMessage.from_message(message).data
+        html_part = MIMEText(self._HTML_MARK, 'html').as_bytes(
+            policy=WIRE_POLICY)
+        self._wire_head, rest = data.split(self._TO_MARK.encode('ascii'))
+        self._wire_middle, self._wire_tail = rest.split(html_part)
+
+    def _build(self, to_, message_html):
+        """Build MIME tree of the message with the cached image."""
+        # Work on a copy, messages may be rendered in parallel
+        email = copy.copy(self.email)
+        email.to_ = to_
+        email.bcc = email.from_
+        email.add_section()
+        email.add_section('Text', 'html', msg=message_html)
+        email.add_section(
+            'Image', image=self.image, image_type=self.image_type,
+            image_filename=self.image_filename)
+        return email.message
+
+    def html_part(self, message_html):
+        """Serialize html part the way ``MIMEText`` does.
+
+        :return: serialized part, None if it can not be done quickly
+        :rtype: str
+        """
+        if '\r' in message_html or self.boundary in message_html:
+            return None
+        try:
+            message_html.encode('ascii')
+        except UnicodeEncodeError:
+            body = base64.encodebytes(message_html.encode('utf-8'))
+            return self._HTML_UTF8 + body.decode('ascii')
+        return self._HTML_ASCII + message_html
+
+    def render(self, to_, message_html):
+        """Return serialized message for one recipient.
+
+        :param to_: receiver email
+        :type to_: str
+        :param message_html: personalized html body
+        :type message_html: str
+        :return: message ready for ``sendmail``
+        :rtype: str
+        """
+        html_part = self.html_part(message_html)
+        if html_part is None or not to_.isascii():
+            # Rare content the chunks can not hold, build it in full
+            return self._build(to_, message_html).as_string()
+        return ''.join(
+            (self._head, to_, self._middle, html_part, self._tail))
+
+    def render_bytes(self, to_, message_html):
+        """Return message for one recipient as wire bytes.
+
+        Same message as ``render`` without the str to bytes round trip
+        and with line ends and dots already as SMTP sends them.
+
+        :param to_: receiver email
+        :type to_: str
+        :param message_html: personalized html body
+        :type message_html: str
+        :return: message ready for ``SmtpPool.sendmail``
+        :rtype: WireMessage
+        """
+        html_part = self.wire_html_part(message_html)
+        if html_part is None or not self.splices(to_):
+            return WireMessage.from_message(self._build(to_, message_html))
+        return self.render_part(to_, html_part)
+
+    def wire_html_part(self, message_html):
+        """Serialize html part as wire bytes.
+
+        :return: serialized part, None if it can not be done quickly
+        :rtype: bytes
+        """
+        html_part = self.html_part(message_html)
+        if html_part is None:
+            return None
+        # html part starts with its headers, no line starts at a chunk
+        return html_part.replace('\n', '\r\n').replace(
+            '\r\n.', '\r\n..').encode('ascii')
+
+    @staticmethod
+    def splices(to_):
+        """Tell if receiver address can be spliced into the chunks."""
+        return to_.isascii() and '\n' not in to_ and '\r' not in to_
+
+    def render_part(self, to_, wire_html_part):
+        """Return message for one recipient from serialized html part.
+
+        :param to_: receiver email, see ``splices``
+        :type to_: str
+        :param wire_html_part: part from ``wire_html_part``
+        :type wire_html_part: bytes-like
+        :return: message ready for ``SmtpPool.sendmail``
+        :rtype: WireMessage
+        """
+        return WireMessage(b''.join((
+            self._wire_head, to_.encode('ascii'), self._wire_middle,
+            wire_html_part, self._wire_tail)))
+
+
+class Email:
+    """Actions necessary to create email."""
+
+    def __init__(
+            self, from_, smtp='smtp.gmail.com', port=465,
+            subject='Test', message=None, use_ssl=True):
+        """Initialize email class.
+
+        :param from_: sender email
+        :type from_: str, optional
+        :param smtp: SMTP host, defaults to 'smtp.gmail.com'
+        :type smtp: str, optional
+        :param port: SMTP port, defaults to 465
+        :type port: int, optional
+        :param subject: email subject, defaults to 'Test'
+        :type subject: str, optional
+        :param message: email body, , defaults to None
+        :type message: text template, optional
+        :param use_ssl: connect with SMTP over SSL, plain SMTP
+            otherwise, defaults to True
+        :type use_ssl: bool, optional
+        """
+        self.smtp = smtp
+        self.port = port
+        self.use_ssl = use_ssl
+        self.from_ = from_
+        self.to_ = None
+        self.bcc = None
+        self.subject = subject
+        self.message = message
+
+    def add_section(
+            self, section='Multipart', subtype='html', msg=None,
+            image=None, image_type=None, image_filename=None):
+        """Add part into multipart email message.
+
+        :param section: type of part email message to add, defaults to
+            'Multipart'
+        :type section: str, optional
+        :param subtype: body message type, defaults to 'html'
         :type subtype: str, optional
         :param msg: contend of the message, defaults to None
         :type msg: str, optional
@@ -228,20 +2811,50 @@ class Email:
         :param test: mode to run function, defaults to True
         :type test: bool, optional
         """
+        self.to_ = self.recipient(email_to, test_add, test)
+        self.bcc = email_bcc
+        self.add_section()
+
+    def recipient(self, email_to, test_add, test=True):
+        """Return receiver address, sender +suffix address in test mode.
+
+        :param email_to: receiver email
+        :type email_to: str
+        :param test_add: suffix add to email for testing with google
+        :type test_add: str
+        :param test: mode to run function, defaults to True
+        :type test: bool, optional
+        :return: receiver email
+        :rtype: str
+        """
         if test:
             tempvar = list(self.from_.partition('@'))
             tempvar.insert(1, ''.join('+{}'.format(test_add)))
-            self.to_ = ''.join(tempvar)
-        else:
-            self.to_ = email_to
-        self.bcc = email_bcc
-        self.add_section()
+            return ''.join(tempvar)
+        return email_to
 
     def process_name_email(
             self, email_password, name_email, signature,
-            image_filename, message_template_html, test_mode=True):
+            image_filename, message_template_html, test_mode=True,
+            pool=None, workers=1, max_connections=None, ledger=None,
+            batch_filter=None, batch_size=50, generic_name='Customer',
+            template_values=None, render_cache=None):
         """Form and send email for each row.
 
+        Messages go through a pool of authenticated SMTP sessions, so
+        the TLS handshake and login happen once per session instead of
+        once per message.  With more than one worker rows are sent in
+        parallel from a thread pool.  The image and the static parts of
+        the message are prepared once for all rows.
+
+        Rows selected by ``batch_filter`` get one non-personalized
+        message addressed to up to ``batch_size`` of them at once, in a
+        single SMTP transaction as with Bcc; the other rows get their
+        personalized message each.
+
+        Templates can use ``PERSON_NAME``, ``SIGNATURE``, ``EMAIL`` (the
+        lead address), ``SUBJECT`` and any name in ``template_values``.
+
         :param email_password: sender password
         :type email_password: str
         :param name_email: name and email, defaults to None
@@ -251,84 +2864,1292 @@ class Email:
         :param image_filename: image file name
         :type image_filename: str
         :param message_template_html: contend of the message template
-        :type message_template_html: text
+        :type message_template_html: Template or CompiledTemplate
+        :param test_mode: send to sender +name address, defaults to True
+        :type test_mode: bool, optional
+        :param pool: SMTP sessions to send with, a pool is opened and
+            closed for the call if None, defaults to None
+        :type pool: SmtpPool, optional
+        :param workers: number of parallel senders, defaults to 1
+        :type workers: int, optional
+        :param max_connections: cap on concurrent connections to the
+            SMTP server for a pool opened by the call, defaults to the
+            number of workers
+        :type max_connections: int, optional
+        :param ledger: record of recipients sent, recipients already in
+            it are skipped, defaults to None
+        :type ledger: SendLedger, optional
+        :param batch_filter: tells if row gets the batched message,
+            no row is batched if None, defaults to None
+        :type batch_filter: callable, optional
+        :param batch_size: recipients of one batched message, defaults
+            to 50
+        :type batch_size: int, optional
+        :param generic_name: PERSON_NAME in batched message, defaults
+            to 'Customer'
+        :type generic_name: str, optional
+        :param template_values: values of other placeholders of the
+            template, defaults to None
+        :type template_values: dict, optional
+        :param render_cache: cache of personalized html parts, defaults
+            to None
+        :type render_cache: RenderCache, optional
+        :return: result for every row in the order of rows
+        :rtype: list of SendResult
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = SmtpPool(
+                self.smtp, self.port, self.from_, email_password,
+                size=min(workers, max_connections or workers),
+                use_ssl=self.use_ssl)
+        skeleton = MessageSkeleton(self, image_filename)
+        values = dict(template_values or {})
+        values.update(SIGNATURE=signature, SUBJECT=self.subject)
+        send_task = functools.partial(
+            self._send_task, pool, values, skeleton,
+            message_template_html, test_mode, ledger, generic_name,
+            render_cache)
+        tasks = self._tasks(name_email, batch_filter, batch_size)
+        try:
+            if workers <= 1:
+                results = [result for task in tasks
+                           for result in send_task(task)]
+            else:
+                results = self._send_concurrent(tasks, send_task, workers)
+            results.sort(key=lambda result: result.index)
+        finally:
+            if own_pool:
+                pool.close()
+            if ledger is not None:
+                ledger.flush()
+        print("Sent {} messages, {:.1f} messages/second".format(
+            pool.sent, pool.rate()))
+        return results
+
+    def process_segments(
+            self, email_password, name_email, segments, image_filename,
+            test_mode=True, pool=None, workers=1, max_connections=None,
+            generic_name='Customer', template_values=None,
+            render_cache=None):
+        """Form and send email of its segment for each row.
+
+        Rows come from one pass over the leads of every segment, the
+        last column of a row is the number of its segment, see
+        ``PostgreSqlDb.iter_segmented_email_list``.  Each row gets the
+        subject, signature and template of its segment and is recorded
+        in the ledger of its segment.
+
+        :param name_email: name, email and segment number
+        :type name_email: dataset
+        :param segments: message of each segment
+        :type segments: list of SegmentMessage
+        :return: result for every row in the order of rows
+        :rtype: list of SendResult
+
+        The other parameters are those of ``process_name_email``.
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = SmtpPool(
+                self.smtp, self.port, self.from_, email_password,
+                size=min(workers, max_connections or workers),
+                use_ssl=self.use_ssl)
+        skeletons = {}
+        send_tasks = []
+        for segment in segments:
+            if segment.subject not in skeletons:
+                email = copy.copy(self)
+                email.subject = segment.subject
+                skeletons[segment.subject] = MessageSkeleton(
+                    email, image_filename)
+            skeleton = skeletons[segment.subject]
+            values = dict(template_values or {})
+            values.update(SIGNATURE=segment.signature,
+                          SUBJECT=segment.subject)
+            send_tasks.append(functools.partial(
+                skeleton.email._send_task, pool, values, skeleton,
+                segment.template, test_mode, segment.ledger, generic_name,
+                render_cache))
+
+        def send_task(task):
+            _, [(_, row)] = task
+            return send_tasks[row[2]](task)
+
+        tasks = self._tasks(name_email, None, 1)
+        try:
+            if workers <= 1:
+                results = [result for task in tasks
+                           for result in send_task(task)]
+            else:
+                results = self._send_concurrent(tasks, send_task, workers)
+            results.sort(key=lambda result: result.index)
+        finally:
+            if own_pool:
+                pool.close()
+            for segment in segments:
+                if segment.ledger is not None:
+                    segment.ledger.flush()
+        print("Sent {} messages, {:.1f} messages/second".format(
+            pool.sent, pool.rate()))
+        return results
+
+    def render_to_outbox(
+            self, outbox, name_email, signature, image_filename,
+            message_template_html, test_mode=True, ledger=None,
+            batch_filter=None, batch_size=50, generic_name='Customer',
+            template_values=None, render_cache=None):
+        """Form email for each row and queue it for later delivery.
+
+        Messages are formed as by ``process_name_email`` and written to
+        the outbox instead of being sent, for ``deliver_outbox`` to
+        send.  Recipients already sent or already queued are skipped.
+
+        :param outbox: queue the messages are written to
+        :type outbox: Outbox
+        :param ledger: record of recipients sent, recipients already in
+            it are skipped, defaults to None
+        :type ledger: SendLedger, optional
+        :return: result for every row in the order of rows, 'queued'
+            rows are in the outbox
+        :rtype: list of SendResult
+
+        The other parameters are those of ``process_name_email``.
+        """
+        def skip(to_):
+            return (outbox.already_queued(to_)
+                    or (ledger is not None and ledger.already_sent(to_)))
+
+        skeleton = MessageSkeleton(self, image_filename)
+        values = dict(template_values or {})
+        values.update(SIGNATURE=signature, SUBJECT=self.subject)
+        results = []
+        try:
+            for task in self._tasks(name_email, batch_filter, batch_size):
+                skipped, recipients, to_addrs, message = self._render_task(
+                    values, skeleton, message_template_html, test_mode,
+                    skip, generic_name, render_cache, task)
+                results.extend(skipped)
+                if recipients:
+                    outbox.put(self.from_, to_addrs, message)
+                    METRICS.count('recipients_queued', len(recipients))
+                    results.extend(SendResult(i, row, 'queued', None)
+                                   for i, row, _ in recipients)
+        finally:
+            outbox.flush()
+        print("Queued {} recipients".format(
+            sum(result.status == 'queued' for result in results)))
+        return results
+
+    async def process_name_email_async(
+            self, email_password, name_email, signature, image_filename,
+            message_template_html, test_mode=True, pool=None,
+            connections=10, ledger=None, generic_name='Customer',
+            template_values=None, render_cache=None, render_executor=None,
+            chunk_size=500):
+        """Form and send email for each row on the asyncio event loop.
+
+        Rows are read in a thread, so a blocking database cursor does
+        not stall the loop, and flow through bounded queues to the
+        renderer and on to ``connections`` concurrent senders, each
+        stage waiting when the next one falls behind, so at most a few
+        chunks of rows and messages are held at a time.  Only the
+        returned results, one ``SendResult`` per row, grow with the
+        rows.  Rendering runs on the loop, or in ``render_executor``
+        for heavy templates.
+
+        :param pool: SMTP sessions to send with, a pool of
+            ``connections`` sessions is opened and closed for the call
+            if None, defaults to None
+        :type pool: AsyncSmtpPool, optional
+        :param connections: number of concurrent senders, defaults
+            to 10
+        :type connections: int, optional
+        :param render_executor: executor rendering messages, on the
+            event loop if None, defaults to None
+        :type render_executor: concurrent.futures.Executor, optional
+        :param chunk_size: rows passed between stages at a time,
+            defaults to 500
+        :type chunk_size: int, optional
+        :return: result for every row in the order of rows
+        :rtype: list of SendResult
+
+        The other parameters are those of ``process_name_email``.
+        """
+        loop = asyncio.get_running_loop()
+        own_pool = pool is None
+        if own_pool:
+            pool = AsyncSmtpPool(
+                self.smtp, self.port, self.from_, email_password,
+                size=connections, use_ssl=self.use_ssl)
+        skeleton = MessageSkeleton(self, image_filename)
+        values = dict(template_values or {})
+        values.update(SIGNATURE=signature, SUBJECT=self.subject)
+        render_task = functools.partial(
+            self._render_task, values, skeleton, message_template_html,
+            test_mode, None if ledger is None else ledger.already_sent,
+            generic_name, render_cache)
+
+        def render_chunk(chunk):
+            return [render_task((False, [row])) for row in chunk]
+
+        rows = asyncio.Queue(maxsize=2)
+        messages = asyncio.Queue(maxsize=2 * connections)
+        results = []
+
+        async def render():
+            while True:
+                chunk = await rows.get()
+                if chunk is None:
+                    break
+                if render_executor is None:
+                    rendered = render_chunk(chunk)
+                else:
+                    rendered = await loop.run_in_executor(
+                        render_executor, render_chunk, chunk)
+                for skipped, recipients, to_addrs, message in rendered:
+                    results.extend(skipped)
+                    if recipients:
+                        await messages.put((recipients, to_addrs, message))
+            for _ in range(connections):
+                await messages.put(None)
+
+        async def deliver():
+            while True:
+                item = await messages.get()
+                if item is None:
+                    break
+                recipients, to_addrs, message = item
+                try:
+                    refused = await pool.sendmail(
+                        self.from_, to_addrs, message)
+                except smtplib.SMTPAuthenticationError:
+                    raise
+                except (smtplib.SMTPException, OSError) as error:
+                    print("Error while sending email to",
+                          ', '.join(to_addrs), error)
+                    refused = dict.fromkeys(to_addrs, error)
+                for i, row, to_ in recipients:
+                    error = refused.get(to_)
+                    if isinstance(error, tuple):
+                        error = smtplib.SMTPRecipientsRefused({to_: error})
+                    if ledger is not None:
+                        ledger.record(to_, error)
+                    status = 'sent' if error is None else 'failed'
+                    METRICS.count('recipients_' + status)
+                    results.append(SendResult(i, row, status, error))
+
+        stop = threading.Event()
+        tasks = [loop.create_task(render())]
+        tasks += [loop.create_task(deliver()) for _ in range(connections)]
+        reader = loop.run_in_executor(
+            None, _feed_rows, name_email, rows, loop, stop, chunk_size)
+        try:
+            await asyncio.gather(reader, *tasks)
+            results.sort(key=lambda result: result.index)
+        finally:
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(reader, *tasks, return_exceptions=True)
+            if own_pool:
+                await pool.close()
+            if ledger is not None:
+                ledger.flush()
+        print("Sent {} messages, {:.1f} messages/second".format(
+            pool.sent, pool.rate()))
+        return results
+
+    @staticmethod
+    def _tasks(name_email, batch_filter, batch_size):
+        """Group rows into sending tasks, print progress.
+
+        :return: (batched, list of (index, row)) for every task
+        :rtype: generator
+        """
+        batch = []
+        for i, row in enumerate(name_email):
+            print("      {}: {}".format(i, row[:2]))
+            if batch_filter is None or not batch_filter(row):
+                yield False, [(i, row)]
+                continue
+            batch.append((i, row))
+            if len(batch) >= batch_size:
+                yield True, batch
+                batch = []
+        if batch:
+            yield True, batch
+
+    @staticmethod
+    def _send_concurrent(tasks, send_task, workers):
+        """Send tasks from a thread pool.
+
+        At most two tasks per worker are in flight, so rows can be
+        pulled lazily from a generator.
+        """
+        results = []
+        pending = set()
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for task in tasks:
+                pending.add(executor.submit(send_task, task))
+                if len(pending) >= 2 * workers:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        results.extend(future.result())
+            done, _ = futures.wait(pending)
+            for future in done:
+                results.extend(future.result())
+        return results
+
+    def _render_task(
+            self, values, skeleton, message_template_html, test_mode,
+            skip, generic_name, render_cache, task):
+        """Form email for the rows of one task.
+
+        :return: results of the rows skipped, (index, row, receiver)
+            of the other rows, their receivers and the message, None
+            if every row was skipped
+        :rtype: tuple
+        """
+        batched, rows = task
+        results, recipients = [], []
+        for i, row in rows:
+            to_ = self.recipient(row[1], row[0], test_mode)
+            if skip is not None and skip(to_):
+                results.append(SendResult(i, row, 'skipped', None))
+                METRICS.count('recipients_skipped')
+            else:
+                recipients.append((i, row, to_))
+        if not recipients:
+            return results, recipients, [], None
+        if batched:
+            # Recipients stay in the envelope only, as with Bcc
+            with METRICS.timer('render'):
+                message_html = message_template_html.substitute(
+                    values, PERSON_NAME=generic_name, EMAIL='')
+            to_addrs = [to_ for _, _, to_ in recipients]
+            with METRICS.timer('serialize'):
+                message = skeleton.render_bytes(self.from_, message_html)
+        else:
+            i, row, to_ = recipients[0]
+            to_addrs = [to_]
+            if render_cache is not None and skeleton.splices(to_):
+                message = self._render_cached(
+                    render_cache, values, skeleton, message_template_html,
+                    row, to_)
+                return results, recipients, to_addrs, message
+            with METRICS.timer('render'):
+                message_html = message_template_html.substitute(
+                    values, PERSON_NAME=_title(row[0]), EMAIL=row[1])
+            with METRICS.timer('serialize'):
+                message = skeleton.render_bytes(to_, message_html)
+        return results, recipients, to_addrs, message
+
+    @staticmethod
+    def _render_cached(
+            render_cache, values, skeleton, message_template_html, row,
+            to_):
+        """Form personalized email, html part from the render cache.
+
+        :return: message ready for ``SmtpPool.sendmail``
+        :rtype: WireMessage
+        """
+        values = dict(values, PERSON_NAME=_title(row[0]), EMAIL=row[1])
+        key = render_cache.key(message_template_html.template, values)
+        with render_cache.read(key) as html_part:
+            if html_part is not None:
+                with METRICS.timer('serialize'):
+                    return skeleton.render_part(to_, html_part)
+        with METRICS.timer('render'):
+            message_html = message_template_html.substitute(values)
+        with METRICS.timer('serialize'):
+            html_part = skeleton.wire_html_part(message_html)
+            if html_part is None:
+                return skeleton.render_bytes(to_, message_html)
+            render_cache.put(key, html_part)
+            return skeleton.render_part(to_, html_part)
+
+    def _send_task(
+            self, pool, values, skeleton, message_template_html,
+            test_mode, ledger, generic_name, render_cache, task):
+        """Form and send email for the rows of one task.
+
+        :return: outcome of sending for every row
+        :rtype: list of SendResult
         """
+        results, recipients, to_addrs, message = self._render_task(
+            values, skeleton, message_template_html, test_mode,
+            None if ledger is None else ledger.already_sent,
+            generic_name, render_cache, task)
+        if not recipients:
+            return results
+        try:
+            refused = pool.sendmail(self.from_, to_addrs, message)
+        except smtplib.SMTPAuthenticationError:
+            raise
+        except (smtplib.SMTPException, OSError) as error:
+            print("Error while sending email to", ', '.join(to_addrs),
+                  error)
+            refused = dict.fromkeys(to_addrs, error)
+        for i, row, to_ in recipients:
+            error = refused.get(to_)
+            if isinstance(error, tuple):
+                error = smtplib.SMTPRecipientsRefused({to_: error})
+            if ledger is not None:
+                ledger.record(to_, error)
+            status = 'sent' if error is None else 'failed'
+            METRICS.count('recipients_' + status)
+            results.append(SendResult(i, row, status, error))
+        return results
+
+
+def _feed_rows(name_email, rows, loop, stop, chunk_size):
+    """Put chunks of (index, row) on asyncio queue, in a thread."""
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(rows.put(item), loop)
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return None
+
+    chunk = []
+    try:
         for i, row in enumerate(name_email):
-            # create message
+            if stop.is_set():
+                return
             print("      {}: {}".format(i, row[:2]))
-            self.email_create(
-                email_to=row[1], email_bcc=self.from_,
-                test=test_mode, test_add=row[0],)
-            message_html = message_template_html.substitute(
-                PERSON_NAME=row[0].title(), SIGNATURE=signature)
-            self.add_section('Text', 'html', msg=message_html)
-
-            # Attach image file to email (inline)
-            with open(image_filename, "rb") as img:
-                _, content_subtype = (
-                    mimetypes.guess_type(img.name)[0].split('/'))
-                self.add_section(
-                    'Image', image=img.read(),
-                    image_type=content_subtype,
-                    image_filename=image_filename)
-
-            # Create secure SSL context
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(
-                    self.smtp, self.port, context=context) as server:
-                server.login(self.from_, email_password)
-                server.sendmail(
-                    self.from_, self.to_, self.message.as_string())
-
-
-def main():
-    """Execute main module."""
-    # Set up database connection credentials
-    user = "postgres"
-    password = input("Enter your Database pass, please: ")
-    host = "localhost"   # default localhost
-    port = "5433"   # default 5432
-    db_ = "crm"   # default postgres
-
-    # Set up your email connection credentials
-    sender_email = input("Type your (sender) email address here: ")
-    email_password = input(
-        "Enter your %s password, here:" % sender_email)
-    image_filename = 'NY.gif'  # Image file for attachment in email
+            chunk.append((i, row))
+            if len(chunk) >= chunk_size:
+                put(chunk)
+                chunk = []
+        if chunk:
+            put(chunk)
+    finally:
+        if not stop.is_set():
+            put(None)
+        close = getattr(name_email, 'close', None)
+        if close is not None:
+            close()
+
+
+def deliver_outbox(outbox, pool, workers=1, ledger=None, claim_size=100):
+    """Send messages queued in the outbox until it is empty.
+
+    Every worker thread claims up to ``claim_size`` messages at a time
+    and sends them through the pool, renewing the claim of the rest
+    before each message.  Workers in other processes can drain the same
+    outbox.  Recipients already in the ledger are not sent again.
+
+    :param outbox: queue of rendered messages
+    :type outbox: Outbox
+    :param pool: SMTP sessions to send with
+    :type pool: SmtpPool
+    :param workers: number of parallel senders, defaults to 1
+    :type workers: int, optional
+    :param ledger: record of recipients sent, defaults to None
+    :type ledger: SendLedger, optional
+    :param claim_size: messages claimed at a time, defaults to 100
+    :type claim_size: int, optional
+    :return: number of recipients by status
+    :rtype: collections.Counter
+    """
+    def drain():
+        counts = collections.Counter()
+        while True:
+            with METRICS.timer('outbox_claim'):
+                messages = outbox.claim(claim_size)
+            if not messages:
+                return counts
+            for number, (message_id, from_addr, to_addrs, message) in (
+                    enumerate(messages)):
+                # Waiting for the rate limiters may take longer than
+                # the lease of the whole batch
+                outbox.renew([claimed[0] for claimed in messages[number:]])
+                if ledger is not None:
+                    sent = [to_ for to_ in to_addrs
+                            if ledger.already_sent(to_)]
+                    counts['skipped'] += len(sent)
+                    METRICS.count('recipients_skipped', len(sent))
+                    to_addrs = [to_ for to_ in to_addrs if to_ not in sent]
+                    if not to_addrs:
+                        outbox.done(message_id)
+                        continue
+                try:
+                    refused = pool.sendmail(from_addr, to_addrs, message)
+                except smtplib.SMTPAuthenticationError:
+                    raise
+                except (smtplib.SMTPException, OSError) as error:
+                    print("Error while sending email to",
+                          ', '.join(to_addrs), error)
+                    refused = dict.fromkeys(to_addrs, error)
+                for to_ in to_addrs:
+                    error = refused.get(to_)
+                    if isinstance(error, tuple):
+                        error = smtplib.SMTPRecipientsRefused({to_: error})
+                    if ledger is not None:
+                        ledger.record(to_, error)
+                    status = 'sent' if error is None else 'failed'
+                    METRICS.count('recipients_' + status)
+                    counts[status] += 1
+                if len(refused) == len(to_addrs):
+                    outbox.done(message_id, refused[to_addrs[0]])
+                else:
+                    outbox.done(message_id, refused=refused)
+
+    total = collections.Counter()
+    try:
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for counts in executor.map(
+                    lambda _: drain(), range(workers)):
+                total.update(counts)
+    finally:
+        outbox.flush()
+        if ledger is not None:
+            ledger.flush()
+    print("Sent {} messages, {:.1f} messages/second".format(
+        pool.sent, pool.rate()))
+    return total
+
+
+def send_campaign(settings, shard_id=0, num_shards=1):
+    """Send email template to the leads of one shard.
+
+    :param settings: database, email and campaign settings
+    :type settings: CampaignSettings
+    :param shard_id: shard to send, defaults to 0
+    :type shard_id: int, optional
+    :param num_shards: number of shards leads are split into, defaults
+        to 1
+    :type num_shards: int, optional
+    :return: number of recipients by status
+    :rtype: collections.Counter
+    """
+    if settings.segments:
+        return _send_segments(settings, shard_id, num_shards)
     subject = False
     signature = False
+    condition = _leads_condition(shard_id, num_shards)
+    template_where = 'id = {}'.format(int(settings.template_id))
+    campaign = _campaign_key(settings, settings.template_id)
+    watermark_name = 'shard {}/{}'.format(shard_id, num_shards)
+    postgresql_db = PostgreSqlDb(
+        settings.db_user, settings.db_password, settings.db_host,
+        settings.db_port, settings.db_name)
+    ledger = _campaign_ledger(settings, campaign)
+    if settings.outbox == 'deliver':
+        # Messages were rendered by an earlier run, just send them
+        return _deliver_campaign(settings, ledger, campaign,
+                                 num_shards, shard_id)
+
+    # One connection shared by the template and email list queries
+    with ledger, postgresql_db:
+        # Get email template from database by id
+        email_template = postgresql_db.email_template(
+            'email_template', 'templ, subject, signature', template_where)
+        print("Email message template...")
+        if email_template:
+            message_template_html = compile_template(
+                settings.template_id, email_template[0][0])
+        try:
+            subject = email_template[0][1]
+            signature = email_template[0][2]
+        except (IndexError, TypeError):
+            print("subject and signature are not defined in the database")
+
+        if not subject:
+            subject = 'Happy New Year!'
+        if not signature:
+            signature = """***<br>"""
+
+        # Get first name, personal email if exists otherwise work email
+        # streamed from the server while emails are being sent
+        if settings.incremental:
+            # Only leads added since the previous run
+            name_email = postgresql_db.iter_email_list_since(
+                'lead', 'first_name', 'email', 'email_work', condition,
+                'id_addr', ledger.watermark(watermark_name))
+        elif settings.copy_streams:
+            name_email = postgresql_db.iter_email_list_copy(
+                'lead', 'first_name', 'email', 'email_work', condition,
+                'id_addr', settings.copy_streams)
+        else:
+            name_email = postgresql_db.iter_email_list_from_db(
+                'lead', 'first_name', 'email', 'email_work', condition,
+                'id_addr')
+        # Same address in several leads gets one email
+        deduper = RecipientDeduper()
+        name_email = dedup_rows(name_email, deduper)
+        print("Proceed with the dataset...")
+
+        if not email_template:
+            return collections.Counter()
+        email_msg = _campaign_email(settings, subject=subject)
+
+        render_cache = None
+        if settings.render_cache:
+            # Recurring campaigns render unchanged messages from disk
+            render_cache = RenderCache(settings.render_cache)
+        if settings.dry_run:
+            return _dry_run(email_msg, settings, num_shards, name_email,
+                            signature, message_template_html, ledger,
+                            render_cache, deduper)
+        if settings.outbox == 'render':
+            with Outbox(settings.outbox_filename, campaign) as outbox:
+                results = email_msg.render_to_outbox(
+                    outbox, name_email, signature, settings.image_filename,
+                    message_template_html, test_mode=settings.test_mode,
+                    ledger=ledger, render_cache=render_cache)
+            if settings.incremental:
+                advance_watermark(ledger, results, watermark_name)
+            print("Duplicate addresses skipped:", deduper.duplicates)
+            return collections.Counter(result.status for result in results)
+
+        if settings.engine == 'async':
+            results = asyncio.run(_send_campaign_async(
+                email_msg, settings, num_shards, shard_id, name_email,
+                signature, message_template_html, ledger, render_cache))
+            if settings.incremental:
+                advance_watermark(ledger, results, watermark_name)
+            print("Duplicate addresses skipped:", deduper.duplicates)
+            return collections.Counter(result.status for result in results)
+
+        pool = _campaign_pool(email_msg, settings, num_shards, shard_id)
+        with pool:
+            results = email_msg.process_name_email(
+                settings.email_password, name_email, signature,
+                settings.image_filename, message_template_html,
+                test_mode=settings.test_mode, pool=pool,
+                workers=settings.workers, ledger=ledger,
+                render_cache=render_cache)
+            if settings.incremental:
+                advance_watermark(ledger, results, watermark_name)
+    print("Duplicate addresses skipped:", deduper.duplicates)
+    return collections.Counter(result.status for result in results)
+
+
+def _campaign_key(settings, template_id):
+    """Return name the ledger and outbox keep campaign records under.
+
+    Records belong to the campaign name and the template, so a rerun
+    of a campaign resumes it while a campaign with a new name, next
+    year's with the same template say, is sent to everybody again.
+    """
+    key = 'id = {}'.format(int(template_id))
+    if settings.campaign:
+        key = '{} {}'.format(settings.campaign, key)
+    return key
+
+
+def _campaign_ledger(settings, campaign):
+    """Open ledger of the campaign, tell if recipients are skipped."""
+    ledger = SendLedger(settings.ledger_filename, campaign)
+    if ledger.sent_count():
+        print("Campaign '{}' was already sent to {} recipients, they are "
+              "skipped; give the campaign a new name to send to them "
+              "again".format(campaign, ledger.sent_count()))
+    return ledger
+
+
+def _leads_condition(shard_id, num_shards):
+    """Return WHERE clause selecting the leads of one shard."""
+    condition = "WHERE (email is NOT NULL OR email_work is NOT NULL)"
+    if num_shards > 1:
+        condition = PostgreSqlDb.shard_condition(
+            condition, 'id_addr', shard_id, num_shards)
+    return condition
+
+
+def _send_segments(settings, shard_id, num_shards):
+    """Send the template of its segment to each lead of one shard.
+
+    The templates of all segments are fetched with one query and the
+    leads are routed to their segment in one pass over the lead table,
+    over the same connection.
+    """
+    template_ids = sorted(
+        {segment.template_id for segment in settings.segments})
+    postgresql_db = PostgreSqlDb(
+        settings.db_user, settings.db_password, settings.db_host,
+        settings.db_port, settings.db_name)
+    # Each template keeps the ledger a single template run would use
+    ledgers = {
+        template_id: _campaign_ledger(
+            settings, _campaign_key(settings, template_id))
+        for template_id in template_ids}
+    with contextlib.ExitStack() as stack:
+        for ledger in ledgers.values():
+            stack.enter_context(ledger)
+        stack.enter_context(postgresql_db)
+        print("Email message templates...")
+        templates = postgresql_db.email_templates(
+            'email_template', 'templ, subject, signature', template_ids)
+        missing = set(template_ids) - set(templates or ())
+        if missing:
+            print("Email templates not found:", sorted(missing))
+            return collections.Counter()
+        messages = []
+        for segment in settings.segments:
+            templ, subject, signature = templates[segment.template_id]
+            messages.append(SegmentMessage(
+                subject or 'Happy New Year!', signature or """***<br>""",
+                compile_template(segment.template_id, templ),
+                ledgers[segment.template_id]))
+
+        # Get first name, email and segment of the leads of every
+        # segment streamed from the server while emails are being sent
+        name_email = postgresql_db.iter_segmented_email_list(
+            'lead', [segment.condition for segment in settings.segments],
+            'first_name', 'email', 'email_work', condition=_leads_condition(
+                shard_id, num_shards), orderby_col='id_addr')
+        # Same address in several leads gets one email
+        deduper = RecipientDeduper()
+        name_email = dedup_rows(name_email, deduper)
+        print("Proceed with the dataset...")
+
+        email_msg = _campaign_email(settings)
+        render_cache = None
+        if settings.render_cache:
+            render_cache = RenderCache(settings.render_cache)
+        with _campaign_pool(email_msg, settings, num_shards, shard_id) as pool:
+            results = email_msg.process_segments(
+                settings.email_password, name_email, messages,
+                settings.image_filename, test_mode=settings.test_mode,
+                pool=pool, workers=settings.workers,
+                render_cache=render_cache)
+    print("Duplicate addresses skipped:", deduper.duplicates)
+    for number, segment in enumerate(settings.segments):
+        print("Segment {}: {}".format(segment.name, dict(collections.Counter(
+            result.status for result in results
+            if result.row[2] == number))))
+    return collections.Counter(result.status for result in results)
+
+
+def _campaign_email(settings, **kwargs):
+    """Return Email sending through the SMTP server of the settings."""
+    return Email(
+        from_=settings.sender_email, smtp=settings.smtp_host,
+        port=settings.smtp_port, use_ssl=settings.smtp_ssl, **kwargs)
+
+
+def _campaign_limiters(num_shards, shard_id=0, per_minute=20, per_day=500):
+    """Return rate limits of one shard of the campaign.
+
+    Limits default to the sending limits of a Gmail account and are
+    shared between the shards.  When a shard's share is less
+    than one message, every bucket would still start with the one
+    message it can hold and the shards together would burst
+    ``num_shards`` messages at once, so the shards start with their
+    first token staggered and take turns instead.
+    """
+    limiters = []
+    for rate, per in ((per_minute, 60), (per_day, 86400)):
+        share = rate / num_shards
+        limiters.append(TokenBucket(
+            share, per=per,
+            tokens=1 - shard_id / num_shards if share < 1 else None))
+    return limiters
+
 
-    # Get email template from database by id
-    postgresql_db = PostgreSqlDb(user, password, host, port, db_)
-    email_template = postgresql_db.email_template(
-        'email_template', 'templ, subject, signature', 'id = 5')
-    print("Email message template...")
-    if email_template:
-        message_template_html = Template(email_template[0][0])
+def _campaign_pool(email_msg, settings, num_shards, shard_id=0):
+    """Return SMTP pool of one shard of the campaign.
+
+    Every worker gets its own session, ``max_connections`` caps them.
+    """
+    return SmtpPool(
+        email_msg.smtp, email_msg.port, settings.sender_email,
+        settings.email_password,
+        size=min(settings.workers,
+                 settings.max_connections or settings.workers),
+        use_ssl=email_msg.use_ssl,
+        limiters=_campaign_limiters(
+            num_shards, shard_id, settings.per_minute, settings.per_day),
+        retries=settings.retries, backoff=settings.backoff)
+
+
+async def _send_campaign_async(
+        email_msg, settings, num_shards, shard_id, name_email, signature,
+        message_template_html, ledger, render_cache):
+    """Send campaign with the asyncio engine."""
+    async with AsyncSmtpPool(
+            email_msg.smtp, email_msg.port, settings.sender_email,
+            settings.email_password, size=settings.connections,
+            use_ssl=email_msg.use_ssl, limiters=_campaign_limiters(
+                num_shards, shard_id, settings.per_minute,
+                settings.per_day),
+            retries=settings.retries, backoff=settings.backoff) as pool:
+        return await email_msg.process_name_email_async(
+            settings.email_password, name_email, signature,
+            settings.image_filename, message_template_html,
+            test_mode=settings.test_mode, pool=pool,
+            connections=settings.connections, ledger=ledger,
+            render_cache=render_cache)
+
+
+def _deliver_campaign(settings, ledger, campaign, num_shards, shard_id):
+    """Send campaign messages queued in the outbox."""
+    email_msg = _campaign_email(settings)
+    outbox = Outbox(settings.outbox_filename, campaign)
+    with ledger, outbox, _campaign_pool(
+            email_msg, settings, num_shards, shard_id) as pool:
+        return deliver_outbox(outbox, pool, settings.workers, ledger=ledger)
+
+
+class DryRunOutbox:
+    """Outbox counting rendered messages instead of keeping them."""
+
+    def __init__(self):
+        """Start with no messages, recipients and bytes counted."""
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+
+    def already_queued(self, recipient):
+        """Tell if a message to the recipient is in the outbox.
+
+        :param recipient: receiver email
+        :type recipient: str
+        :return: always False, a dry run renders every recipient
+        :rtype: bool
+        """
+        return False
+
+    def put(self, from_addr, to_addrs, message):
+        """Count message instead of queueing it.
+
+        :param from_addr: sender email
+        :type from_addr: str
+        :param to_addrs: receiver emails
+        :type to_addrs: list of str
+        :param message: message ready for ``sendmail``
+        :type message: str or WireMessage
+        """
+        self.messages += 1
+        self.recipients += len(to_addrs)
+        self.bytes += len(
+            message.data if isinstance(message, WireMessage) else message)
+
+    def flush(self):
+        """Do nothing, nothing is kept to be written."""
+
+
+def _dry_run(email_msg, settings, num_shards, name_email, signature,
+             message_template_html, ledger, render_cache, deduper):
+    """Fetch and render campaign without sending, report throughput.
+
+    Nothing is recorded in the ledger and the high-water mark stays, so
+    the real run sends everything the dry run rendered.
+    """
+    outbox = DryRunOutbox()
+    started = time.perf_counter()
+    results = email_msg.render_to_outbox(
+        outbox, name_email, signature, settings.image_filename,
+        message_template_html, test_mode=settings.test_mode,
+        ledger=ledger, render_cache=render_cache)
+    elapsed = time.perf_counter() - started
+    print("Duplicate addresses skipped:", deduper.duplicates)
+    print("Dry run: {} messages to {} recipients, {:.1f} MiB, fetched and "
+          "rendered in {:.1f} s, {:.1f} messages/second".format(
+              outbox.messages, outbox.recipients, outbox.bytes / 2 ** 20,
+              elapsed, outbox.messages / elapsed if elapsed else 0.0))
+    if num_shards == 1:
+        _report_send_time(settings, [outbox.messages], num_shards)
+    return collections.Counter(result.status for result in results)
+
+
+def _report_send_time(settings, shard_messages, num_shards):
+    """Print time the sending limits take to send rendered messages.
+
+    Shards send in parallel, each under its share of the limits, and
+    every limit starts with a full burst.
+
+    :param settings: campaign settings with the sending limits
+    :type settings: CampaignSettings
+    :param shard_messages: messages of each shard
+    :type shard_messages: list of int
+    :param num_shards: number of shards leads are split into
+    :type num_shards: int
+    """
+    limiters = _campaign_limiters(
+        num_shards, per_minute=settings.per_minute, per_day=settings.per_day)
+    seconds = max(
+        [limiter.seconds_for(messages)
+         for messages in shard_messages for limiter in limiters],
+        default=0.0)
+    print("Projected send time of {} messages under the sending limits: "
+          "{:.1f} hours".format(sum(shard_messages), seconds / 3600))
+
+
+def advance_watermark(ledger, results, name):
+    """Move high-water mark past the leads the campaign is done with.
+
+    The mark stops before the first lead not sent, skipped or queued,
+    so the next run reads it again, and the leads after it, which the
+    ledger skips if they were sent.
+
+    :param ledger: ledger keeping the mark
+    :type ledger: SendLedger
+    :param results: results of rows with their key values
+    :type results: list of SendResult
+    :param name: name of the mark
+    :type name: str
+    """
+    keys = None
+    for result in sorted(results, key=lambda result: result.index):
+        if result.status not in ('sent', 'skipped', 'queued'):
+            break
+        keys = result.row[2:]
+    if keys is not None:
+        ledger.set_watermark(keys, name)
+
+
+def _send_shard(args):
+    """Send one shard in a worker process."""
+    settings, shard_id, num_shards = args
+    METRICS.enabled = settings.metrics
+    # A worker process may run several shards, report each on its own
+    METRICS.reset()
+    counts = send_campaign(settings, shard_id, num_shards)
+    return shard_id, counts, METRICS.snapshot()
+
+
+def run_sharded(settings, num_shards, shard_ids=None, processes=None):
+    """Send campaign split into shards, one worker process per shard.
+
+    Leads are split into ``num_shards`` shards by a hash of their id.
+    All shards run on this host by default; to spread a campaign over
+    hosts every host runs its own ``shard_ids`` with the same
+    ``num_shards``.  Duplicate addresses are dropped within a shard
+    only, an address shared by leads of two shards gets an email from
+    each; the ledger of the template skips it on later runs.
+
+    :param settings: database, email and campaign settings
+    :type settings: CampaignSettings
+    :param num_shards: number of shards leads are split into
+    :type num_shards: int
+    :param shard_ids: shards to run here, defaults to all of them
+    :type shard_ids: list of int, optional
+    :param processes: worker processes, defaults to one per shard
+    :type processes: int, optional
+    :return: number of recipients by status for all shards run
+    :rtype: collections.Counter
+    """
+    if shard_ids is None:
+        shard_ids = range(num_shards)
+    tasks = [(settings, shard_id, num_shards) for shard_id in shard_ids]
+    total = collections.Counter()
+    shard_messages = []
+    started = time.perf_counter()
+    with multiprocessing.Pool(processes or len(tasks)) as workers:
+        for shard_id, counts, metrics in workers.imap_unordered(
+                _send_shard, tasks):
+            print("Shard {}/{} done: {}".format(
+                shard_id, num_shards, dict(counts)))
+            total.update(counts)
+            # Campaign messages have one recipient each
+            shard_messages.append(counts['queued'])
+            METRICS.merge(metrics)
+    elapsed = time.perf_counter() - started
+    print("All {} shards done: {}, {:.1f} messages/second".format(
+        len(tasks), dict(total), total['sent'] / elapsed))
+    if settings.dry_run:
+        print("Dry run: {} messages rendered, {:.1f} messages/second".format(
+            total['queued'], total['queued'] / elapsed))
+        _report_send_time(settings, shard_messages, num_shards)
+    return total
+
+
+# Options of the config file and their defaults, each one can be
+# overridden by environment variable SEND_EMAIL_<SECTION>_<OPTION>
+CONFIG_DEFAULTS = {
+    'database': {
+        'user': 'postgres', 'host': 'localhost', 'port': '5433',
+        'name': 'crm'},
+    'email': {'sender': ''},
+    # Sending limits default to the ones of a Gmail account
+    'smtp': {
+        'host': 'smtp.gmail.com', 'port': '465', 'ssl': 'yes',
+        'per_minute': '20', 'per_day': '500', 'retries': '3',
+        'backoff': '1.0'},
+    'campaign': {
+        'name': '', 'template_id': '5', 'image': 'NY.gif',
+        'test_mode': 'yes',
+        'ledger': 'send_ledger.sqlite', 'outbox': 'send_outbox.sqlite'},
+}
+CONFIG_FILE = 'send_email.ini'
+# Credentials are read from the environment only
+DB_PASSWORD_ENV = 'SEND_EMAIL_DB_PASSWORD'
+EMAIL_PASSWORD_ENV = 'SEND_EMAIL_PASSWORD'
+
+
+def load_config(filename=None, environ=None):
+    """Read settings from config file and environment variables.
+
+    :param filename: config file, ``CONFIG_FILE`` if it exists when
+        None, defaults to None
+    :type filename: str, optional
+    :param environ: environment variables, defaults to ``os.environ``
+    :type environ: dict, optional
+    :return: every option of ``CONFIG_DEFAULTS``
+    :rtype: configparser.ConfigParser
+    """
+    environ = os.environ if environ is None else environ
+    config = configparser.ConfigParser()
+    config.read_dict(CONFIG_DEFAULTS)
+    if filename is not None:
+        with open(filename) as config_file:
+            config.read_file(config_file)
+    else:
+        config.read(CONFIG_FILE)
+    for section in CONFIG_DEFAULTS:
+        for option in CONFIG_DEFAULTS[section]:
+            name = 'SEND_EMAIL_{}_{}'.format(section, option).upper()
+            if name in environ:
+                config[section][option] = environ[name]
+    return config
+
+
+def load_segments(config):
+    """Return segments defined in ``[segment NAME]`` config sections.
+
+    Each section has the ``template_id`` sent to the segment and the
+    SQL ``condition`` on the lead table selecting it, no condition
+    selects every lead left.  Leads go to the first segment in the
+    file they match::
+
+        [segment vip]
+        template_id = 7
+        condition = vip
+
+        [segment others]
+        template_id = 5
+
+    :param config: settings read by ``load_config``
+    :type config: configparser.ConfigParser
+    :return: segments in the order of the config file
+    :rtype: list of Segment
+    """
+    return [
+        Segment(section.split(None, 1)[1],
+                config.getint(section, 'template_id'),
+                config.get(section, 'condition', fallback=''))
+        for section in config.sections()
+        if section.split(None, 1)[0] == 'segment' and ' ' in section]
+
+
+def _credential(environ, name, prompt):
+    """Return credential from the environment, ask only on a terminal.
+
+    :return: credential, None if not set and nobody can be asked
+    :rtype: str
+    """
+    value = environ.get(name)
+    if not value and sys.stdin.isatty():
+        value = getpass.getpass(prompt)
+    return value or None
+
+
+def main(argv=None, environ=None):
+    """Execute main module.
+
+    Settings come from the config file and the environment, so the
+    job can run from cron or in worker processes without a terminal.
+    """
+    environ = os.environ if environ is None else environ
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog='Passwords are read from the {} and {} environment '
+               'variables.'.format(DB_PASSWORD_ENV, EMAIL_PASSWORD_ENV))
+    parser.add_argument(
+        '--config',
+        help='config file (default {} if it exists)'.format(CONFIG_FILE))
+    parser.add_argument(
+        '--template-id', type=int,
+        help='email template to send (default from the config file)')
+    parser.add_argument(
+        '--campaign',
+        help='campaign name, a rerun of a campaign skips recipients '
+             'already sent, a new name sends to everybody again '
+             '(default from the config file)')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='read leads and render messages without sending, report '
+             'throughput')
+    parser.add_argument(
+        '--num-shards', type=int, default=1,
+        help='split leads into that many shards (default 1)')
+    parser.add_argument(
+        '--shard-id', type=int, action='append',
+        help='shard to send from this host, repeatable (default all)')
+    parser.add_argument(
+        '--processes', type=int,
+        help='worker processes (default one per shard)')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='send only to leads added since the previous run')
+    parser.add_argument(
+        '--copy-streams', type=int, default=0,
+        help='read leads with COPY over that many parallel streams '
+             '(default 0, read with a cursor)')
+    parser.add_argument(
+        '--create-index', action='store_true',
+        help='create the index incremental runs read leads with, '
+             'without blocking writes to the leads, and exit')
+    parser.add_argument(
+        '--outbox', choices=('render', 'deliver'),
+        help='render messages into the outbox file without sending, '
+             'or deliver messages rendered into it earlier')
+    parser.add_argument(
+        '--outbox-file',
+        help='outbox file (default from the config file)')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='threads sending messages with the sync engine and from '
+             'the outbox (default 1)')
+    parser.add_argument(
+        '--max-connections', type=int,
+        help='most SMTP connections the workers share (default one per '
+             'worker)')
+    parser.add_argument(
+        '--engine', choices=('sync', 'async'), default='sync',
+        help='send with threads and blocking sockets, or with asyncio '
+             '(default sync)')
+    parser.add_argument(
+        '--connections', type=int, default=10,
+        help='concurrent SMTP connections of the async engine '
+             '(default 10)')
+    parser.add_argument(
+        '--render-cache', metavar='DIRECTORY',
+        help='keep rendered messages in that directory and reuse the '
+             'unchanged ones when the campaign is sent again under a '
+             'new --campaign name')
+    parser.add_argument(
+        '--metrics', action='store_true',
+        help='time campaign stages and print a summary at the end')
+    parser.add_argument(
+        '--metrics-file',
+        help='also write metrics to that file, Prometheus text format '
+             'if it ends with .prom, JSON lines otherwise')
+    args = parser.parse_args(argv)
+    if args.num_shards < 1:
+        parser.error('--num-shards must be at least 1')
+    if args.workers < 1 or (args.max_connections is not None
+                            and args.max_connections < 1):
+        parser.error('--workers and --max-connections must be at least 1')
+    if any(shard_id not in range(args.num_shards)
+           for shard_id in args.shard_id or ()):
+        parser.error('--shard-id must be from 0 to {}'.format(
+            args.num_shards - 1))
+    if args.dry_run and args.outbox:
+        parser.error('--dry-run renders without an outbox')
+    METRICS.enabled = args.metrics or bool(args.metrics_file)
     try:
-        subject = email_template[0][1]
-        signature = email_template[0][2]
-    except IndexError:
-        print("subject and signature are not defined in the database")
-
-    if not subject:
-        subject = 'Happy New Year!'
-    if not signature:
-        signature = """***<br>"""
-
-    # Get first name, personal email if exists otherwise work email
-    name_email = postgresql_db.email_list_from_db(
-        'lead', 'first_name', 'email', 'email_work',
-        "WHERE (email is NOT NULL OR email_work is NOT NULL)",
-        'id_addr')
-    print("Proceed with the dataset...")
-
-    if name_email:
-        email_msg = Email(from_=sender_email, subject=subject)
-
-        email_msg.process_name_email(
-            email_password, name_email, signature, image_filename,
-            message_template_html, test_mode=True)
+        config = load_config(args.config, environ)
+        test_mode = config.getboolean('campaign', 'test_mode')
+        smtp = config['smtp']
+        smtp_settings = dict(
+            smtp_host=smtp['host'], smtp_port=smtp.getint('port'),
+            smtp_ssl=smtp.getboolean('ssl'),
+            per_minute=smtp.getfloat('per_minute'),
+            per_day=smtp.getfloat('per_day'),
+            retries=smtp.getint('retries'),
+            backoff=smtp.getfloat('backoff'))
+        if smtp_settings['per_minute'] <= 0 or smtp_settings['per_day'] <= 0:
+            raise ValueError('smtp per_minute and per_day must be positive')
+        template_id = args.template_id or config.getint(
+            'campaign', 'template_id')
+        # A template given on the command line is sent to every lead
+        segments = () if args.template_id else load_segments(config)
+    except (OSError, configparser.Error, ValueError) as error:
+        parser.error('config: {}'.format(error))
+
+    if segments and (args.dry_run or args.outbox or args.incremental
+                     or args.copy_streams or args.engine != 'sync'):
+        parser.error('segments are sent with the sync engine only, '
+                     'without --dry-run, --outbox, --incremental and '
+                     '--copy-streams')
+
+    db_password = email_password = None
+    if args.outbox != 'deliver' or args.create_index:
+        db_password = _credential(
+            environ, DB_PASSWORD_ENV, "Enter your Database pass, please: ")
+        if db_password is None:
+            parser.error('set {}'.format(DB_PASSWORD_ENV))
+    database = config['database']
+    index = (
+        'lead', 'id_addr',
+        "WHERE (email is NOT NULL OR email_work is NOT NULL)")
+    if args.create_index:
+        # Prepares the lead table for incremental runs, sends nothing
+        error = PostgreSqlDb(
+            database['user'], db_password, database['host'],
+            database['port'], database['name']
+        ).create_incremental_index(*index)
+        if error is not None:
+            sys.exit("Index not created: {}".format(error))
+        print("Index created:", PostgreSqlDb.incremental_index(
+            *index, concurrently=True))
+        return
+    sender_email = config['email']['sender']
+    if not sender_email:
+        parser.error('set sender in the [email] section of the config '
+                     'file or SEND_EMAIL_EMAIL_SENDER')
+    if not args.dry_run and args.outbox != 'render':
+        email_password = _credential(
+            environ, EMAIL_PASSWORD_ENV,
+            "Enter your %s password, here:" % sender_email)
+        if email_password is None:
+            parser.error('set {}'.format(EMAIL_PASSWORD_ENV))
+
+    settings = CampaignSettings(
+        db_user=database['user'],
+        db_password=db_password,
+        db_host=database['host'],
+        db_port=database['port'],
+        db_name=database['name'],
+        sender_email=sender_email,
+        email_password=email_password,
+        template_id=template_id,
+        image_filename=config['campaign']['image'],
+        test_mode=test_mode,
+        ledger_filename=config['campaign']['ledger'],
+        incremental=args.incremental,
+        copy_streams=args.copy_streams,
+        render_cache=args.render_cache,
+        engine=args.engine,
+        connections=args.connections,
+        dry_run=args.dry_run,
+        segments=tuple(segments),
+        campaign=(args.campaign if args.campaign is not None
+                  else config['campaign']['name']),
+        workers=args.workers,
+        max_connections=args.max_connections,
+        **smtp_settings,
+        metrics=METRICS.enabled,
+        outbox=args.outbox,
+        outbox_filename=args.outbox_file or config['campaign']['outbox'])
+
+    if args.incremental:
+        print("Suggested index:", PostgreSqlDb.incremental_index(
+            *index, concurrently=True))
+
+    if args.num_shards == 1:
+        send_campaign(settings)
+    else:
+        run_sharded(
+            settings, args.num_shards, args.shard_id, args.processes)
+
+    if METRICS.enabled:
+        print(METRICS.summary())
+    if args.metrics_file:
+        with open(args.metrics_file, 'w') as metrics_file:
+            metrics_file.write(
+                METRICS.to_prometheus()
+                if args.metrics_file.endswith('.prom')
+                else METRICS.to_json_lines())
 
 
 if __name__ == "__main__":
@@ -7,10 +7,53 @@ __version__ = '1.0'
 
 """
 
+import asyncio
+import contextlib
+import io
+import os
+import queue
+import smtplib
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
 from send_email import PostgreSqlDb
+from send_email import _copy_rows
+from send_email import _CopyWriter
+from send_email import _CopyCancelled
+from send_email import load_config
+from send_email import load_segments
+from send_email import Segment
+from send_email import SegmentMessage
+from send_email import main
+from send_email import send_campaign
+from send_email import CampaignSettings
 from send_email import Email
+from send_email import SmtpPool
+from send_email import AsyncSmtpPool
+from send_email import MessageSkeleton
+from send_email import WireMessage
+from send_email import SendLedger
+from send_email import SendResult
+from send_email import advance_watermark
+from send_email import Outbox
+from send_email import deliver_outbox
+from send_email import TokenBucket
+from send_email import _campaign_limiters
+from send_email import CompiledTemplate
+from send_email import TemplateCache
+from send_email import RenderCache
+from send_email import BloomFilter
+from send_email import RecipientDeduper
+from send_email import dedup_rows
+from send_email import normalize_address
+from send_email import Metrics
+from send_email import METRICS
+from fake_smtp import FakeSmtpServer
+from bench_send_email import SeededPostgreSqlDb
 # import send_email
 
 
@@ -25,8 +68,81 @@ class TestSendEmail(unittest.TestCase):
         pass
 
 
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.config = os.path.join(self.directory.name, 'send_email.ini')
+        with open(self.config, 'w') as config_file:
+            config_file.write('[email]\nsender = Test@Test.com\n'
+                              '[campaign]\ntemplate_id = 7\n')
+
+    def test_load_config(self):
+        config = load_config(self.config, {
+            'SEND_EMAIL_DATABASE_PORT': '5432',
+            'SEND_EMAIL_CAMPAIGN_TEST_MODE': 'no'})
+        self.assertEqual(config['email']['sender'], 'Test@Test.com')
+        self.assertEqual(config.getint('campaign', 'template_id'), 7)
+        self.assertEqual(config['database']['port'], '5432')
+        self.assertEqual(config['database']['name'], 'crm')
+        self.assertFalse(config.getboolean('campaign', 'test_mode'))
+        self.assertEqual(config.getint('smtp', 'per_minute'), 20)
+
+    def test_load_segments(self):
+        with open(self.config, 'a') as config_file:
+            config_file.write('[segment vip]\ntemplate_id = 8\n'
+                              'condition = vip\n'
+                              '[segment others]\ntemplate_id = 7\n')
+        self.assertEqual(load_segments(load_config(self.config, {})), [
+            Segment('vip', 8, 'vip'), Segment('others', 7, '')])
+
+    def test_missing_credentials_do_not_block(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr), \
+                unittest.mock.patch('sys.stdin', io.StringIO()), \
+                self.assertRaises(SystemExit):
+            main(['--config', self.config], {})
+        self.assertIn('SEND_EMAIL_DB_PASSWORD', stderr.getvalue())
+        with contextlib.redirect_stderr(stderr), \
+                self.assertRaises(SystemExit):
+            main(['--config', os.path.join(self.directory.name, 'none')],
+                 {})
+
+    def test_create_index_sends_nothing(self):
+        connections = []
+
+        class IndexDb(SeededPostgreSqlDb):
+            def __init__(self, *args):
+                super().__init__(5)
+
+            def connect_db(self):
+                super().connect_db()
+                connections.append(self.connection)
+
+        stdout = io.StringIO()
+        with unittest.mock.patch('send_email.PostgreSqlDb', IndexDb), \
+                unittest.mock.patch('send_email.send_campaign') as send, \
+                contextlib.redirect_stdout(stdout):
+            main(['--config', self.config, '--create-index'],
+                 {'SEND_EMAIL_DB_PASSWORD': 'secret'})
+        send.assert_not_called()
+        self.assertIn(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS lead_id_addr_idx",
+            connections[0].queries[-1])
+        self.assertFalse(connections[0].autocommit)
+        self.assertIn('Index created', stdout.getvalue())
+
+    def test_shard_id_out_of_range(self):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr), \
+                self.assertRaises(SystemExit):
+            main(['--config', self.config, '--num-shards', '4',
+                  '--shard-id', '4'], {})
+        self.assertIn('--shard-id must be from 0 to 3', stderr.getvalue())
+
+
 class TestPostgreSqlDb(unittest.TestCase):
-    passw = input("Enter your Database password: ")
+    passw = os.environ.get('TEST_DB_PASSWORD', 'postgrespass')
     val_test = 'Test'
     val_templ = 'Test. Dear ${PERSON_NAME}, ${SIGNATURE} end.'
     val_test_emails = ['Test@Test.com', 'Testwork@Test.com']
@@ -98,12 +214,156 @@ class TestPostgreSqlDb(unittest.TestCase):
         self.assertEqual(row[0][0], self.val_test)
         self.assertIn(row[0][1], self.val_test_emails)
 
+    def test_iter_email_list_from_db(self):
+        print('\n----------- Test_1 PostgreSqlDb.iter_email_list_from_db\n')
+        rows = list(self.connection_posgtresql_1.iter_email_list_from_db(
+            'lead', 'first_name', 'email', 'email_work',
+            "WHERE (email is NOT NULL OR email_work is NOT NULL) and"
+            + " id_addr = 1", 'id_addr', itersize=1))
+        self.assertEqual(rows[0][0], self.val_test)
+        self.assertIn(rows[0][1], self.val_test_emails)
+        # connection is closed once the rows are consumed
+        self.assertIsNone(self.connection_posgtresql_1.connection)
+
+    def test_iter_email_list_copy(self):
+        print('\n----------- Test_1 PostgreSqlDb.iter_email_list_copy\n')
+        condition = "WHERE (email is NOT NULL OR email_work is NOT NULL)"
+        all_rows = self.connection_posgtresql_1.email_list_from_db(
+            'lead', 'first_name', 'email', 'email_work', condition,
+            'id_addr')
+        rows = list(self.connection_posgtresql_1.iter_email_list_copy(
+            'lead', 'first_name', 'email', 'email_work', condition,
+            'id_addr'))
+        self.assertEqual(rows, all_rows)
+        print('\n----------- Test_2 PostgreSqlDb.iter_email_list_copy\n')
+        # parallel streams read every row once
+        rows = list(self.connection_posgtresql_1.iter_email_list_copy(
+            'lead', 'first_name', 'email', 'email_work', condition,
+            'id_addr', streams=3))
+        self.assertEqual(sorted(rows), sorted(all_rows))
+        self.assertEqual(
+            len(self.connection_posgtresql_1.key_ranges(
+                'lead', 'id_addr', condition, 3)), 3)
+
+    def test_shard_condition(self):
+        print('\n----------- Test_1 PostgreSqlDb.shard_condition\n')
+        self.assertEqual(
+            PostgreSqlDb.shard_condition(
+                "WHERE email is NOT NULL", 'id_addr', 1, 4),
+            "WHERE (email is NOT NULL) AND "
+            "mod(hashtext(id_addr::text) & 2147483647, 4) = 1")
+        print('\n----------- Test_2 PostgreSqlDb.shard_condition\n')
+        # every row belongs to exactly one shard
+        rows = []
+        for shard_id in range(3):
+            condition = PostgreSqlDb.shard_condition(
+                None, 'id_addr', shard_id, 3)
+            rows += self.connection_posgtresql_1.email_list_from_db(
+                'lead', 'first_name', 'email', 'email_work',
+                condition + " and id_addr = 1", 'id_addr')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][0], self.val_test)
+
+    def test_iter_segmented_email_list(self):
+        print('\n----------- Test_1 PostgreSqlDb.segment_case\n')
+        self.assertEqual(
+            PostgreSqlDb.segment_case(['vip', '']),
+            "CASE WHEN (vip) THEN 0 WHEN (TRUE) THEN 1 END")
+        print('\n----------- Test_2 '
+              'PostgreSqlDb.iter_segmented_email_list\n')
+        rows = list(self.connection_posgtresql_1.iter_segmented_email_list(
+            'lead', ['id_addr = 2', 'id_addr = 1'], 'first_name', 'email',
+            'email_work', "WHERE id_addr <= 1", 'id_addr'))
+        self.assertEqual(rows, [(self.val_test, self.val_test_emails[0], 1)])
+
+    def test_shard_condition_with_query_parameters(self):
+        # Sharded incremental runs pass parameters with the condition
+        postgresql_db = SeededPostgreSqlDb(5)
+        with postgresql_db:
+            rows = list(postgresql_db.iter_email_list_since(
+                'lead', 'first_name', 'email', 'email_work',
+                PostgreSqlDb.shard_condition(
+                    "WHERE email is NOT NULL", 'id_addr', 1, 4),
+                'id_addr', ['3']))
+            query = postgresql_db.connection.queries[-1]
+        self.assertEqual(len(rows), 5)
+        self.assertIn("mod(hashtext(id_addr::text) & 2147483647, 4) = 1",
+                      query)
+        self.assertIn("(id_addr) > ('3') ORDER BY id_addr LIMIT 1000",
+                      query)
+
+    def test_iter_email_list_since(self):
+        print('\n----------- Test_1 PostgreSqlDb.iter_email_list_since\n')
+        condition = "WHERE (email is NOT NULL OR email_work is NOT NULL)"
+        rows = list(self.connection_posgtresql_1.iter_email_list_since(
+            'lead', 'first_name', 'email', 'email_work', condition,
+            'id_addr', page_size=1))
+        all_rows = self.connection_posgtresql_1.email_list_from_db(
+            'lead', 'first_name', 'email', 'email_work', condition,
+            'id_addr')
+        self.assertEqual([row[:2] for row in rows], all_rows)
+        print('\n----------- Test_2 PostgreSqlDb.iter_email_list_since\n')
+        # nothing is new after the last row
+        self.assertEqual(list(
+            self.connection_posgtresql_1.iter_email_list_since(
+                'lead', 'first_name', 'email', 'email_work', condition,
+                'id_addr', rows[-1][2:])), [])
+
+    def test_incremental_index(self):
+        print('\n----------- Test_1 PostgreSqlDb.incremental_index\n')
+        self.assertEqual(
+            PostgreSqlDb.incremental_index(
+                'lead', 'id_addr', "WHERE email is NOT NULL"),
+            "CREATE INDEX IF NOT EXISTS lead_id_addr_idx ON lead (id_addr)"
+            " WHERE email is NOT NULL")
+
+    def test_shared_connection(self):
+        print('\n----------- Test_1 PostgreSqlDb shared connection\n')
+        with PostgreSqlDb('postgres', 'postgrespass', 'localhost', '5433',
+                          'crm', probe_version=False) as postgresql_db:
+            self.assertIsNone(postgresql_db.connection)
+            postgresql_db.email_template(
+                'email_template', 'templ', 'id = 1')
+            connection = postgresql_db.connection
+            row = postgresql_db.email_template(
+                'email_template', 'templ', 'id = 1')
+            self.assertIs(postgresql_db.connection, connection)
+            self.assertEqual(row[0][0], self.val_templ)
+        self.assertIsNone(postgresql_db.connection)
+
+
+class TestCopyRows(unittest.TestCase):
+    def test_copy_rows(self):
+        self.assertEqual(_copy_rows(
+            'anna\t\\N\n'
+            'tab\\there\tback\\\\slash\t\\101\\x42\\n\n'
+            'partial\t'), [
+                ('anna', None),
+                ('tab\there', 'back\\slash', 'AB\n')])
+
+    def test_lines_split_across_writes(self):
+        chunks = queue.Queue()
+        writer = _CopyWriter(chunks, threading.Event(), chunk_size=1)
+        for data in (b'an', b'na\t\\N\nJos', '\u00e9'.encode()[:1],
+                     '\u00e9'.encode()[1:], b'\tx\\ty\n'):
+            writer.write(data)
+        writer.flush()
+        self.assertEqual(chunks.get_nowait(), [('anna', None)])
+        self.assertEqual(chunks.get_nowait(), [('Jos\u00e9', 'x\ty')])
+        self.assertTrue(chunks.empty())
+
+    def test_cancelled(self):
+        stop = threading.Event()
+        stop.set()
+        with self.assertRaises(_CopyCancelled):
+            _CopyWriter(queue.Queue(), stop).put([('anna', None)])
+
 
 class TestEmail(unittest.TestCase):
     test_name_email = [('Test', 'Test@Test.com')]
     test_email = 'Test@Test.com'
     # input("Enter your @gmail.com email: ")
-    email_passw = input("Enter your %s password: " % test_email)
+    email_passw = os.environ.get('TEST_EMAIL_PASSWORD', '')
 
     def setUp(self):
         print('\nsetUp **********************')
@@ -150,5 +410,791 @@ class TestEmail(unittest.TestCase):
         #     image, message_template)
 
 
+class TestCompiledTemplate(unittest.TestCase):
+    templates = [
+        'Test. Dear ${PERSON_NAME}, ${SIGNATURE} end.',
+        'Dear $PERSON_NAME, pay $$5 to $EMAIL.$PERSON_NAME',
+        'Test. No placeholders.',
+        '']
+    values = {'PERSON_NAME': 'Test', 'SIGNATURE': 'TestSignature',
+              'EMAIL': 'Test@Test.com'}
+
+    def test_same_as_string_template(self):
+        for text in self.templates:
+            self.assertEqual(CompiledTemplate(text).substitute(self.values),
+                             Template(text).substitute(self.values))
+            self.assertEqual(
+                CompiledTemplate(text).safe_substitute(PERSON_NAME='T'),
+                Template(text).safe_substitute(PERSON_NAME='T'))
+
+    def test_errors(self):
+        with self.assertRaises(KeyError):
+            CompiledTemplate(self.templates[0]).substitute(PERSON_NAME='T')
+        with self.assertRaises(ValueError):
+            CompiledTemplate('Test $ 5').substitute(self.values)
+        self.assertEqual(
+            CompiledTemplate('Test $ 5').safe_substitute(), 'Test $ 5')
+
+    def test_identifiers(self):
+        self.assertEqual(CompiledTemplate(self.templates[1]).identifiers,
+                         ['PERSON_NAME', 'EMAIL'])
+
+    def test_cache(self):
+        cache = TemplateCache(maxsize=2)
+        first = cache.get(1, self.templates[0])
+        self.assertIs(cache.get(1, self.templates[0]), first)
+        # changed content is compiled again
+        self.assertIsNot(cache.get(1, self.templates[1]), first)
+        cache.get(2, self.templates[0])
+        self.assertIsNot(cache.get(1, self.templates[0]), first)
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_key(self):
+        key = RenderCache.key('Dear ${PERSON_NAME}', {'PERSON_NAME': 'A'})
+        self.assertEqual(
+            key, RenderCache.key('Dear ${PERSON_NAME}', {'PERSON_NAME': 'A'}))
+        self.assertNotEqual(
+            key, RenderCache.key('Dear ${PERSON_NAME}', {'PERSON_NAME': 'B'}))
+        self.assertNotEqual(
+            key, RenderCache.key('Hi ${PERSON_NAME}', {'PERSON_NAME': 'A'}))
+
+    def test_read_put_evict(self):
+        cache = RenderCache(self.directory.name, max_bytes=10)
+        with cache.read('aa1') as data:
+            self.assertIsNone(data)
+        cache.put('aa1', b'12345')
+        cache.put('bb2', b'')
+        cache.put('cc3', b'12345')
+        with cache.read('aa1') as data:
+            self.assertEqual(bytes(data), b'12345')
+        with cache.read('bb2') as data:
+            self.assertEqual(data, b'')
+        # aa1 was read last, cc3 is the least recently used one
+        cache.put('dd4', b'12345')
+        with cache.read('cc3') as data:
+            self.assertIsNone(data)
+        # entries are kept for the next run
+        cache = RenderCache(self.directory.name, max_bytes=10)
+        self.assertEqual(cache.size, 10)
+        with cache.read('dd4') as data:
+            self.assertEqual(bytes(data), b'12345')
+
+    def test_process_name_email(self):
+        rows = [('test', 'Test@Test.com'), ('test2', 'T2@Test.com')]
+        cache = RenderCache(self.directory.name)
+        sizes = []
+        with FakeSmtpServer() as server:
+            email = Email('Test@Test.com', 'localhost', server.port, 'Test',
+                          use_ssl=False)
+            for _ in range(2):
+                email.process_name_email(
+                    'secret', rows, 'TestSignature', 'NY.gif',
+                    CompiledTemplate('Dear ${PERSON_NAME} \u00e9'), False,
+                    render_cache=cache)
+                sizes.append(cache.size)
+        # second run is served from the cache
+        self.assertGreater(sizes[0], 0)
+        self.assertEqual(sizes[0], sizes[1])
+        for first, second in zip(server.messages[:2], server.messages[2:]):
+            self.assertEqual(first.rcpt_tos, second.rcpt_tos)
+            self.assertEqual(len(first.content), len(second.content))
+
+
+class TestDedup(unittest.TestCase):
+    rows = [('test', ' Test@Test.com'), ('test2', 'test@test.com'),
+            ('test3', 'Test+news@Gmail.com'), ('test4', 'test@gmail.com'),
+            ('test5', 'test+news@test.com'), ('test6', None),
+            ('test7', 'T7@Test.com')]
+
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address(' Test@Test.COM\n'),
+                         'test@test.com')
+        self.assertEqual(normalize_address('Test+Test@googlemail.com'),
+                         'test@googlemail.com')
+        # +tag is part of the mailbox for other domains
+        self.assertEqual(normalize_address('test+test@test.com'),
+                         'test+test@test.com')
+        self.assertIsNone(normalize_address(''))
+
+    def test_dedup_rows(self):
+        self.assertEqual(
+            [row[0] for row in dedup_rows(self.rows)],
+            ['test', 'test3', 'test5', 'test7'])
+
+    def test_dedup_rows_bloom_filter(self):
+        deduper = RecipientDeduper(max_exact=2, capacity=100)
+        self.assertEqual(
+            [row[0] for row in dedup_rows(self.rows, deduper)],
+            ['test', 'test3', 'test5', 'test7'])
+        self.assertEqual(deduper.duplicates, 2)
+
+    def test_bloom_filter_false_positives_are_sent(self):
+        # Bloom filter too small to tell any addresses apart
+        deduper = RecipientDeduper(max_exact=1, capacity=1, error_rate=0.5)
+        self.addCleanup(deduper.close)
+        rows = [('test', 'T{}@Test.com'.format(i)) for i in range(50)]
+        self.assertEqual(list(dedup_rows(rows + rows[:5], deduper)), rows)
+        self.assertEqual(deduper.duplicates, 5)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 1e-4)
+        self.assertFalse(bloom.add('test@test.com'))
+        self.assertTrue(bloom.add('test@test.com'))
+        added = [bloom.add('T{}@Test.com'.format(i)) for i in range(999)]
+        self.assertFalse(any(added))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_disabled_records_nothing(self):
+        metrics = Metrics()
+        with metrics.timer('render'):
+            metrics.count('recipients_sent')
+        self.assertEqual(metrics.snapshot(),
+                         {'stages': {}, 'counters': {}})
+
+    def test_export(self):
+        metrics = Metrics(enabled=True)
+        with metrics.timer('render'):
+            pass
+        metrics.observe('render', 0.5)
+        metrics.count('recipients_sent', 3)
+        calls, total, longest = metrics.stages['render']
+        self.assertEqual((calls, longest), (2, 0.5))
+        self.assertIn('inform_customers_stage_seconds_count'
+                      '{stage="render"} 2', metrics.to_prometheus())
+        self.assertIn('inform_customers_recipients_sent_total 3',
+                      metrics.to_prometheus())
+        self.assertIn('"counter": "recipients_sent", "value": 3',
+                      metrics.to_json_lines())
+        self.assertIn('render', metrics.summary())
+
+    def test_reset(self):
+        metrics = Metrics(enabled=True)
+        metrics.count('messages_sent')
+        metrics.observe('render', 0.5)
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(),
+                         {'stages': {}, 'counters': {}})
+
+    def test_merge(self):
+        metrics = Metrics(enabled=True)
+        metrics.observe('render', 0.5)
+        other = Metrics(enabled=True)
+        other.observe('render', 0.25)
+        other.count('recipients_sent')
+        metrics.merge(other.snapshot())
+        self.assertEqual(metrics.stages['render'], (2, 0.75, 0.5))
+        self.assertEqual(metrics.counters['recipients_sent'], 1)
+
+    def test_process_name_email_stages(self):
+        METRICS.enabled = True
+        self.addCleanup(setattr, METRICS, 'enabled', False)
+        self.addCleanup(METRICS.reset)
+        with FakeSmtpServer() as server:
+            Email('Test@Test.com', 'localhost', server.port, 'Test',
+                  use_ssl=False).process_name_email(
+                'secret', [('test', 'Test@Test.com')], 'TestSignature',
+                'NY.gif', Template('Dear ${PERSON_NAME}'), False)
+        for stage in ('render', 'serialize', 'smtp_connect', 'smtp_login',
+                      'smtp_send'):
+            self.assertIn(stage, METRICS.stages)
+
+
+class TestMessageSkeleton(unittest.TestCase):
+    def setUp(self):
+        self.email = Email('Test@Test.com', subject='Test')
+        self.skeleton = MessageSkeleton(self.email, 'NY.gif')
+
+    def assertSameAsFullBuild(self, to_, message_html):
+        message = self.skeleton._build(to_, message_html)
+        message.set_boundary(self.skeleton.boundary)
+        self.assertEqual(
+            self.skeleton.render(to_, message_html), message.as_string())
+
+    def test_render_ascii(self):
+        self.assertSameAsFullBuild(
+            'T2@Test.com', 'Test. Dear Test, TestSignature end.')
+
+    def test_render_non_ascii(self):
+        self.assertSameAsFullBuild(
+            'T2@Test.com', 'Test. Dear Zo\u00eb, TestSignature end.' * 10)
+
+    def test_render_falls_back_to_full_build(self):
+        message_html = 'Test.\r\nDear Test, TestSignature end.'
+        self.assertIn(
+            'Dear Test', self.skeleton.render('T2@Test.com', message_html))
+        self.assertIn(b'Dear Test', bytes(self.skeleton.render_bytes(
+            'T2@Test.com', message_html)))
+
+    def test_render_bytes(self):
+        for message_html in ('Test.\n.Dear Test,\n.\nend.',
+                             'Test. Dear Zo\u00eb, TestSignature end.'):
+            data = self.skeleton.render_bytes('T2@Test.com', message_html)
+            self.assertIsInstance(data, WireMessage)
+            text = self.skeleton.render('T2@Test.com', message_html)
+            self.assertEqual(bytes(data), text.replace('\n', '\r\n').replace(
+                '\r\n.', '\r\n..').encode('ascii'))
+
+    def test_wire_message_delivered_as_is(self):
+        message_html = 'Test.\n.Dear Test,\n.\nend.'
+        with FakeSmtpServer(pipelining=False) as server, SmtpPool(
+                'localhost', server.port, 'Test@Test.com', 'secret',
+                use_ssl=False) as pool:
+            for to_addrs in (['T2@Test.com'], ['T2@Test.com', 'T3@Test.com']):
+                pool.sendmail('Test@Test.com', to_addrs,
+                              self.skeleton.render_bytes(
+                                  'T2@Test.com', message_html))
+        text = self.skeleton.render('T2@Test.com', message_html)
+        for message in server.messages:
+            self.assertEqual(message.content.decode('ascii'),
+                             text.replace('\n', '\r\n'))
+        self.assertEqual(server.messages[1].rcpt_tos,
+                         ['T2@Test.com', 'T3@Test.com'])
+
+
+class TestSmtpPool(unittest.TestCase):
+    test_name_email = [('test', 'Test@Test.com'), ('test2', 'T2@Test.com'),
+                       ('test3', 'T3@Test.com')]
+    message_template = Template(
+        'Test. Dear ${PERSON_NAME}, ${SIGNATURE} end.')
+
+    def setUp(self):
+        self.server = FakeSmtpServer(password='secret').start()
+        self.email = Email(
+            'Test@Test.com', 'localhost', self.server.port, 'Test',
+            use_ssl=False)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_process_name_email_logs_in_once(self):
+        self.email.process_name_email(
+            'secret', self.test_name_email, 'TestSignature', 'NY.gif',
+            self.message_template, False)
+        self.assertEqual(self.server.stats['messages'], 3)
+        self.assertEqual(self.server.stats['logins'], 1)
+        self.assertEqual(self.server.messages[1].rcpt_tos, ['T2@Test.com'])
+        self.assertIn(b'Dear Test2, TestSignature end.',
+                      self.server.messages[1].content)
+
+    def test_process_name_email_concurrent(self):
+        self.server.latency = 0.01
+        rows = [('test{}'.format(i), 'T{}@Test.com'.format(i))
+                for i in range(12)]
+        results = self.email.process_name_email(
+            'secret', rows, 'TestSignature', 'NY.gif',
+            self.message_template, False, workers=4, max_connections=2)
+        self.assertEqual([result.row for result in results], rows)
+        self.assertTrue(
+            all(result.status == 'sent' for result in results))
+        self.assertEqual(self.server.stats['messages'], 12)
+        self.assertLessEqual(self.server.stats['connections'], 2)
+
+    def test_process_name_email_compiled_template(self):
+        self.email.process_name_email(
+            'secret', self.test_name_email[:1], 'TestSignature', 'NY.gif',
+            CompiledTemplate('Dear ${PERSON_NAME} <$EMAIL>, $SUBJECT '
+                             'from $COMPANY'), False,
+            template_values={'COMPANY': 'TestCompany'})
+        self.assertIn(b'Dear Test <Test@Test.com>, Test from TestCompany',
+                      self.server.messages[0].content)
+
+    def test_process_segments(self):
+        segments = [
+            SegmentMessage('TestVip', 'VipSignature',
+                           Template('Vip ${PERSON_NAME}, ${SIGNATURE}.'),
+                           None),
+            SegmentMessage('Test', 'TestSignature', self.message_template,
+                           None)]
+        rows = [(name, email, i % 2) for i, (name, email)
+                in enumerate(self.test_name_email)]
+        results = self.email.process_segments(
+            'secret', rows, segments, 'NY.gif', False, workers=2)
+        self.assertEqual([result.row for result in results], rows)
+        self.assertEqual(self.server.stats['messages'], 3)
+        contents = {message.rcpt_tos[0]: message.content
+                    for message in self.server.messages}
+        self.assertIn(b'Subject: TestVip', contents['Test@Test.com'])
+        self.assertIn(b'Vip Test, VipSignature.', contents['Test@Test.com'])
+        self.assertIn(b'Dear Test2, TestSignature end.',
+                      contents['T2@Test.com'])
+        self.assertIn(b'Subject: Test\n', contents['T2@Test.com']
+                      .replace(b'\r\n', b'\n'))
+        self.assertIn(b'Vip Test3', contents['T3@Test.com'])
+
+    def test_recycle_after_max_messages(self):
+        with SmtpPool('localhost', self.server.port, 'Test@Test.com',
+                      'secret', max_messages=2, use_ssl=False) as pool:
+            for _ in range(5):
+                pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+            self.assertEqual(pool.sent, 5)
+        self.assertEqual(self.server.stats['logins'], 3)
+
+    def test_reconnect_when_server_disconnects(self):
+        self.server.disconnect_after = 1
+        with SmtpPool('localhost', self.server.port, 'Test@Test.com',
+                      'secret', use_ssl=False) as pool:
+            for _ in range(3):
+                pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+        self.assertEqual(self.server.stats['messages'], 3)
+        self.assertEqual(self.server.stats['logins'], 3)
+
+
+class TestBatchedDelivery(unittest.TestCase):
+    message_template = Template(
+        'Test. Dear ${PERSON_NAME}, ${SIGNATURE} end.')
+    rows = [('test{}'.format(i), 'T{}@Test.com'.format(i))
+            for i in range(7)]
+
+    def setUp(self):
+        self.server = FakeSmtpServer().start()
+        self.email = Email(
+            'Test@Test.com', 'localhost', self.server.port, 'Test',
+            use_ssl=False)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def send(self, **kwargs):
+        return self.email.process_name_email(
+            'secret', self.rows, 'TestSignature', 'NY.gif',
+            self.message_template, False, **kwargs)
+
+    def test_batch_many_recipients_per_message(self):
+        results = self.send(batch_filter=lambda row: True, batch_size=3)
+        self.assertEqual([result.status for result in results],
+                         ['sent'] * 7)
+        self.assertEqual(self.server.stats['messages'], 3)
+        self.assertEqual(self.server.messages[0].rcpt_tos,
+                         ['T0@Test.com', 'T1@Test.com', 'T2@Test.com'])
+        self.assertIn(b'Dear Customer,', self.server.messages[0].content)
+        self.assertIn(b'To: Test@Test.com', self.server.messages[0].content)
+
+    def test_mix_batched_and_personalized(self):
+        results = self.send(
+            batch_filter=lambda row: row[0] in ('test1', 'test4'),
+            workers=2)
+        self.assertEqual([result.row for result in results], self.rows)
+        self.assertEqual(self.server.stats['messages'], 6)
+        batched = [message for message in self.server.messages
+                   if len(message.rcpt_tos) > 1]
+        self.assertEqual(batched[0].rcpt_tos, ['T1@Test.com', 'T4@Test.com'])
+
+    def test_batch_without_pipelining(self):
+        self.server.pipelining = False
+        self.send(batch_filter=lambda row: True)
+        self.assertEqual(self.server.stats['messages'], 1)
+        self.assertEqual(len(self.server.messages[0].rcpt_tos), 7)
+
+
+class TestThrottling(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSmtpServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def pool(self, **kwargs):
+        return SmtpPool('localhost', self.server.port, 'Test@Test.com',
+                        'secret', use_ssl=False, backoff=0.01, **kwargs)
+
+    def test_retry_transient_codes(self):
+        self.server.reject_mail = [451, 421, 454]
+        with self.pool() as pool:
+            pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+        self.assertEqual(self.server.stats['throttled'], 3)
+        self.assertEqual(self.server.stats['messages'], 1)
+
+    def test_give_up_after_retries(self):
+        self.server.reject_mail = [451, 451, 451]
+        with self.pool(retries=2) as pool:
+            with self.assertRaises(smtplib.SMTPSenderRefused):
+                pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+        self.assertEqual(self.server.stats['messages'], 0)
+
+    def test_permanent_code_is_not_retried(self):
+        self.server.reject_mail = [550]
+        with self.pool() as pool:
+            with self.assertRaises(smtplib.SMTPSenderRefused):
+                pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+        self.assertEqual(self.server.stats['throttled'], 1)
+
+    def test_lost_reply_to_data_is_not_retried(self):
+        self.server.drop_data_replies = 1
+        with self.pool() as pool:
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+            # A session lost before the data is sent again
+            self.server.disconnect_after = 1
+            pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+            pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+        self.assertEqual(self.server.stats['messages'], 3)
+
+    def test_pipelined_421_slows_down(self):
+        self.server.reject_mail = [421]
+        limiter = TokenBucket(100)
+        with self.pool(limiters=[limiter]) as pool:
+            pool.sendmail('Test@Test.com', ['T1@Test.com', 'T2@Test.com'],
+                          'Test')
+        self.assertLess(limiter.rate, limiter.max_rate)
+        self.assertEqual(self.server.stats['connections'], 2)
+        self.assertEqual(self.server.messages[0].rcpt_tos,
+                         ['T1@Test.com', 'T2@Test.com'])
+
+    def test_limiter_slows_down_when_throttled(self):
+        self.server.max_rate = 10
+        limiter = TokenBucket(100)
+        with self.pool(limiters=[limiter], retries=10) as pool:
+            for _ in range(30):
+                pool.sendmail('Test@Test.com', 'Test@Test.com', 'Test')
+        self.assertEqual(self.server.stats['messages'], 30)
+        self.assertLess(limiter.rate, limiter.max_rate)
+
+    def test_token_bucket_seconds_for(self):
+        # A full bucket sends its burst at once, the rest at its rate
+        self.assertEqual(TokenBucket(20, per=60).seconds_for(20), 0)
+        self.assertAlmostEqual(
+            TokenBucket(20, per=60).seconds_for(400), 1140)
+        self.assertEqual(TokenBucket(500, per=86400).seconds_for(400), 0)
+
+    def test_shards_take_turns_under_split_limit(self):
+        for num_shards in (4, 32, 1000):
+            buckets = [_campaign_limiters(num_shards, shard_id)[0]
+                       for shard_id in range(num_shards)]
+            # All shards together burst no more than the account limit
+            self.assertLessEqual(
+                sum(int(bucket.tokens) for bucket in buckets), 20)
+            if num_shards > 20:
+                # and send no more than 20 within a minute
+                self.assertEqual(sum(
+                    int(bucket.tokens + bucket.rate * 59)
+                    for bucket in buckets), 20)
+
+    def test_campaign_limiters(self):
+        per_minute, per_day = _campaign_limiters(4, 1, 100, 1000)
+        self.assertEqual(per_minute.rate, 25 / 60)
+        self.assertEqual(per_day.rate, 250 / 86400)
+
+    def test_token_bucket_split_between_shards(self):
+        # Less than one token per shard still lets a message through
+        for bucket in (TokenBucket(20 / 32, per=60),
+                       TokenBucket(500 / 1000, per=86400)):
+            self.assertEqual(bucket.capacity, 1)
+            started = time.monotonic()
+            bucket.acquire()
+            self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_token_bucket_rate(self):
+        limiter = TokenBucket(50, capacity=1)
+        started = time.perf_counter()
+        for _ in range(11):
+            limiter.acquire()
+        self.assertGreaterEqual(time.perf_counter() - started, 0.18)
+
+
+class TestAsyncEngine(unittest.TestCase):
+    test_name_email = [('test{}'.format(i), 'T{}@Test.com'.format(i))
+                       for i in range(20)]
+    message_template = Template(
+        'Test. Dear ${PERSON_NAME}, ${SIGNATURE} end.')
+
+    def send(self, server, rows, **kwargs):
+        email = Email('Test@Test.com', 'localhost', server.port, 'Test',
+                      use_ssl=False)
+        return asyncio.run(email.process_name_email_async(
+            'secret', iter(rows), 'TestSignature', 'NY.gif',
+            self.message_template, False, **kwargs))
+
+    def test_concurrent_connections(self):
+        with FakeSmtpServer(latency=0.001) as server, \
+                unittest.mock.patch('socket.getfqdn',
+                                    return_value='test.host') as getfqdn:
+            results = self.send(server, self.test_name_email,
+                                connections=4, chunk_size=3)
+        # Host name is looked up once for all sessions of the pool
+        getfqdn.assert_called_once_with()
+        self.assertEqual([result.status for result in results],
+                         ['sent'] * 20)
+        self.assertEqual([result.index for result in results],
+                         list(range(20)))
+        self.assertEqual(server.stats['logins'], 4)
+        self.assertEqual(
+            sorted(message.rcpt_tos[0] for message in server.messages),
+            sorted(email for _, email in self.test_name_email))
+        self.assertIn(b'Dear Test7,', b''.join(
+            message.content for message in server.messages))
+
+    def test_without_pipelining_and_with_executor(self):
+        with FakeSmtpServer(pipelining=False) as server:
+            with ThreadPoolExecutor(2) as executor:
+                results = self.send(server, self.test_name_email[:3],
+                                    connections=2, render_executor=executor)
+        self.assertEqual([result.status for result in results],
+                         ['sent'] * 3)
+
+    def test_retry_transient_codes(self):
+        with FakeSmtpServer(reject_mail=[451, 421]) as server:
+            email = Email('Test@Test.com', 'localhost', server.port, 'Test',
+                          use_ssl=False)
+
+            async def send():
+                async with AsyncSmtpPool(
+                        'localhost', server.port, 'Test@Test.com', 'secret',
+                        size=1, use_ssl=False, backoff=0.01) as pool:
+                    return await email.process_name_email_async(
+                        'secret', self.test_name_email[:1], 'TestSignature',
+                        'NY.gif', self.message_template, False, pool=pool,
+                        connections=1)
+
+            results = asyncio.run(send())
+        self.assertEqual(results[0].status, 'sent')
+        self.assertEqual(server.stats['messages'], 1)
+
+    def test_login_failure_stops_sending(self):
+        with FakeSmtpServer(password='other') as server:
+            with self.assertRaises(smtplib.SMTPAuthenticationError):
+                self.send(server, self.test_name_email, connections=2)
+        self.assertEqual(server.stats['messages'], 0)
+
+
+class TestSendLedger(unittest.TestCase):
+    test_name_email = [('test', 'Test@Test.com'), ('test2', 'T2@Test.com'),
+                       ('test3', 'T3@Test.com')]
+    message_template = Template(
+        'Test. Dear ${PERSON_NAME}, ${SIGNATURE} end.')
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'ledger.sqlite')
+        self.server = FakeSmtpServer().start()
+        self.email = Email(
+            'Test@Test.com', 'localhost', self.server.port, 'Test',
+            use_ssl=False)
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def send(self, rows):
+        with SendLedger(self.filename, 'Test', batch_size=2) as ledger:
+            return self.email.process_name_email(
+                'secret', rows, 'TestSignature', 'NY.gif',
+                self.message_template, False, ledger=ledger)
+
+    def test_rerun_skips_recipients_sent(self):
+        self.send(self.test_name_email[:2])
+        results = self.send(self.test_name_email)
+        self.assertEqual([result.status for result in results],
+                         ['skipped', 'skipped', 'sent'])
+        self.assertEqual(self.server.stats['messages'], 3)
+
+    def test_campaigns_are_separate(self):
+        with SendLedger(self.filename, 'Test') as ledger:
+            ledger.record('Test@Test.com')
+        with SendLedger(self.filename, 'Other') as ledger:
+            self.assertFalse(ledger.already_sent('Test@Test.com'))
+        with SendLedger(self.filename, 'Test') as ledger:
+            self.assertTrue(ledger.already_sent('Test@Test.com'))
+            ledger.record('T2@Test.com', OSError('Test'))
+        with SendLedger(self.filename, 'Test') as ledger:
+            self.assertFalse(ledger.already_sent('T2@Test.com'))
+
+    def test_watermark(self):
+        with SendLedger(self.filename, 'Test') as ledger:
+            self.assertIsNone(ledger.watermark())
+            ledger.set_watermark([41])
+            ledger.set_watermark([42])
+            ledger.set_watermark(['2020-01-01', 7], 'shard 1/2')
+        with SendLedger(self.filename, 'Test') as ledger:
+            self.assertEqual(ledger.watermark(), ['42'])
+            self.assertEqual(ledger.watermark('shard 1/2'),
+                             ['2020-01-01', '7'])
+        with SendLedger(self.filename, 'Other') as ledger:
+            self.assertIsNone(ledger.watermark())
+
+    def test_watermark_stops_before_failed_lead(self):
+        results = [SendResult(i, ('test', 'T{}@Test.com'.format(i), i + 1),
+                              status, None)
+                   for i, status in enumerate(
+                       ['skipped', 'sent', 'failed', 'sent'])]
+        with SendLedger(self.filename, 'Test') as ledger:
+            advance_watermark(ledger, results[2:], 'leads')
+            self.assertIsNone(ledger.watermark())
+            advance_watermark(ledger, results, 'leads')
+            self.assertEqual(ledger.watermark(), ['2'])
+
+
+class TestOutbox(unittest.TestCase):
+    test_name_email = [('test', 'Test@Test.com'), ('test2', 'T2@Test.com'),
+                       ('test3', 'T3@Test.com')]
+    message_template = Template(
+        'Test. Dear ${PERSON_NAME}, ${SIGNATURE} end.')
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'outbox.sqlite')
+        self.server = FakeSmtpServer().start()
+        self.email = Email(
+            'Test@Test.com', 'localhost', self.server.port, 'Test',
+            use_ssl=False)
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def render(self, rows):
+        with Outbox(self.filename, 'Test', batch_size=2) as outbox:
+            return self.email.render_to_outbox(
+                outbox, rows, 'TestSignature', 'NY.gif',
+                self.message_template, False)
+
+    def deliver(self, workers=1):
+        with Outbox(self.filename, 'Test') as outbox, SmtpPool(
+                'localhost', self.server.port, 'Test@Test.com', 'secret',
+                size=workers, use_ssl=False) as pool:
+            return deliver_outbox(outbox, pool, workers, claim_size=1)
+
+    def test_render_then_deliver(self):
+        results = self.render(self.test_name_email)
+        self.assertEqual([result.status for result in results],
+                         ['queued'] * 3)
+        self.assertEqual(self.server.stats['connections'], 0)
+        self.assertEqual(self.deliver(workers=2), {'sent': 3})
+        self.assertEqual(
+            sorted(message.rcpt_tos[0] for message in self.server.messages),
+            ['T2@Test.com', 'T3@Test.com', 'Test@Test.com'])
+        self.assertIn(b'Dear Test2,', b''.join(
+            message.content for message in self.server.messages))
+        # Nothing is sent twice
+        self.assertEqual(self.deliver(), {})
+        self.assertEqual(self.server.stats['messages'], 3)
+
+    def test_rerender_skips_recipients_queued(self):
+        self.render(self.test_name_email[:2])
+        results = self.render(self.test_name_email)
+        self.assertEqual([result.status for result in results],
+                         ['skipped', 'skipped', 'queued'])
+        with Outbox(self.filename, 'Test') as outbox:
+            self.assertEqual(outbox.counts(), {'queued': 3})
+
+    def test_expired_claim_is_delivered_again(self):
+        self.render(self.test_name_email[:1])
+        with Outbox(self.filename, 'Test', lease=0) as outbox:
+            self.assertEqual(len(outbox.claim()), 1)
+            # Worker crashed before acknowledging, lease expired
+            time.sleep(0.01)
+            self.assertEqual(len(outbox.claim()), 1)
+        with Outbox(self.filename, 'Test') as outbox:
+            self.assertEqual(outbox.claim(), [])
+            self.assertEqual(outbox.counts(), {'claimed': 1})
+
+    def test_done_is_written_at_once(self):
+        self.render(self.test_name_email[:2])
+        with Outbox(self.filename, 'Test') as outbox, \
+                Outbox(self.filename, 'Test', lease=0) as other:
+            first, second = outbox.claim()
+            outbox.done(first[0])
+            time.sleep(0.01)
+            # Only the message not acknowledged is handed out again
+            self.assertEqual([claimed[0] for claimed in other.claim()],
+                             [second[0]])
+
+    def test_failed_recipients_are_queued_again(self):
+        self.render(self.test_name_email[:1])
+        self.server.reject_mail = [550]
+        self.assertEqual(self.deliver(), {'failed': 1})
+        results = self.render(self.test_name_email[:1])
+        self.assertEqual(results[0].status, 'queued')
+        self.assertEqual(self.deliver(), {'sent': 1})
+
+    def test_partially_refused_message(self):
+        with Outbox(self.filename, 'Test') as outbox:
+            outbox.put('Test@Test.com', ['Test@Test.com', 'T2@Test.com'],
+                       'message')
+            [(message_id, _, _, _)] = outbox.claim()
+            outbox.done(message_id,
+                        refused={'T2@Test.com': (550, b'No such user')})
+        with Outbox(self.filename, 'Test') as outbox:
+            self.assertEqual(outbox.counts(), {'partial': 1})
+            self.assertTrue(outbox.already_queued('Test@Test.com'))
+            self.assertFalse(outbox.already_queued('T2@Test.com'))
+
+    def test_deliver_skips_recipients_in_ledger(self):
+        self.render(self.test_name_email[:2])
+        with SendLedger(os.path.join(self.directory.name, 'ledger.sqlite'),
+                        'Test') as ledger, \
+                Outbox(self.filename, 'Test') as outbox, SmtpPool(
+                    'localhost', self.server.port, 'Test@Test.com',
+                    'secret', use_ssl=False) as pool:
+            ledger.record('Test@Test.com')
+            self.assertEqual(deliver_outbox(outbox, pool, ledger=ledger),
+                             {'sent': 1, 'skipped': 1})
+            self.assertEqual(outbox.counts(), {'sent': 2})
+        self.assertEqual(self.server.messages[0].rcpt_tos, ['T2@Test.com'])
+
+
+class TestSendCampaign(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.server = FakeSmtpServer().start()
+        self.addCleanup(self.server.stop)
+        self.settings = CampaignSettings(
+            'bench', 'bench', 'localhost', '5433', 'crm', 'Test@Test.com',
+            'secret', 3, 'NY.gif', False,
+            os.path.join(self.directory.name, 'ledger.sqlite'),
+            smtp_host='localhost', smtp_port=self.server.port,
+            smtp_ssl=False, backoff=0.01)
+
+    def send(self, **settings):
+        with unittest.mock.patch('send_email.PostgreSqlDb',
+                                 lambda *args: SeededPostgreSqlDb(4)), \
+                contextlib.redirect_stdout(io.StringIO()) as stdout:
+            counts = send_campaign(self.settings._replace(**settings))
+        return counts, stdout.getvalue()
+
+    def test_new_campaign_name_sends_again(self):
+        self.assertEqual(self.send()[0], {'sent': 4})
+        counts, stdout = self.send()
+        self.assertEqual(counts, {'skipped': 4})
+        self.assertIn('give the campaign a new name', stdout)
+        self.assertEqual(self.send(campaign='2027')[0], {'sent': 4})
+        self.assertEqual(self.send(campaign='2027')[0], {'skipped': 4})
+        self.assertEqual(self.server.stats['messages'], 8)
+
+    def test_smtp_settings(self):
+        self.server.reject_mail = [421, 421]
+        self.assertEqual(self.send(retries=1)[0],
+                         {'sent': 3, 'failed': 1})
+        self.assertEqual(self.send(engine='async')[0],
+                         {'sent': 1, 'skipped': 3})
+
+    def test_workers_share_max_connections(self):
+        self.server.latency = 0.05
+        self.assertEqual(self.send(workers=3, max_connections=2)[0],
+                         {'sent': 4})
+        self.assertEqual(self.server.stats['connections'], 2)
+
+    def test_render_cache_hits_when_campaign_is_sent_again(self):
+        METRICS.enabled = True
+        self.addCleanup(setattr, METRICS, 'enabled', False)
+        self.addCleanup(METRICS.reset)
+        render_cache = os.path.join(self.directory.name, 'cache')
+        self.send(campaign='2026', render_cache=render_cache)
+        self.assertEqual(METRICS.counters['render_cache_misses'], 4)
+        self.assertNotIn('render_cache_hits', METRICS.counters)
+        METRICS.reset()
+        self.assertEqual(
+            self.send(campaign='2027', render_cache=render_cache)[0],
+            {'sent': 4})
+        self.assertEqual(METRICS.counters['render_cache_hits'], 4)
+        self.assertNotIn('render_cache_misses', METRICS.counters)
+
+
 if __name__ == "__main__":
     unittest.main()